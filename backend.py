@@ -0,0 +1,234 @@
+import os
+import threading
+from typing import Protocol
+import cv2 as cv
+import numpy as np
+from buffers import BufferPool
+from metrics import Metrics, \
+    NO_METRICS
+
+Offset = tuple[int, int]
+Region = tuple[int, int, int, int]   # left, top, width, height
+
+CAPTURE_MARGIN = 16
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+class Backend(Protocol):
+    tile_padding: int | None
+    field_padding: int | None
+
+    def screenshot(self, region: Region | None = None) -> np.ndarray: ...
+
+    def click(self, x: float, y: float, button: str = "left") -> None: ...
+
+
+def crop_region(image: np.ndarray, region: Region | None) -> np.ndarray:
+    if region is None:
+        return image
+    left, top, width, height = region
+    return image[top:top + height, left:left + width]
+
+
+class ScreenBackend:
+    tile_padding: int | None = None
+    field_padding: int | None = None
+
+    def __init__(self, method: str = "auto") -> None:
+        # Imported here so headless runs never touch the display.
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.mss = None
+        if method in ("auto", "mss"):
+            try:
+                import mss
+                self.mss = mss
+            except ImportError:
+                if method == "mss":
+                    raise
+        elif method != "pyautogui":
+            raise ValueError(f"Unknown capture method: {method}")
+        # mss handles can't be shared between threads.
+        self.local = threading.local()
+        self.buffers = BufferPool()
+
+    def screenshot(self, region: Region | None = None) -> np.ndarray:
+        if self.mss is None:
+            return np.array(self.pyautogui.screenshot(region=region))
+
+        if not hasattr(self.local, "grabber"):
+            self.local.grabber = self.mss.mss()
+        # The primary monitor, which is what PyAutoGUI captures too.
+        monitor = self.local.grabber.monitors[1]
+        if region is not None:
+            left, top, width, height = region
+            monitor = {"left": monitor["left"] + left,
+                       "top": monitor["top"] + top,
+                       "width": width, "height": height}
+        shot = np.asarray(self.local.grabber.grab(monitor))
+        return cv.cvtColor(shot, cv.COLOR_BGRA2RGB, dst=self.buffers.get(
+            "screen", (*shot.shape[:2], 3)))
+
+    def click(self, x: float, y: float, button: str = "left") -> None:
+        self.pyautogui.click(x, y, button=button)
+
+
+class FileBackend:
+    tile_padding: int | None = None
+    field_padding: int | None = None
+
+    def __init__(self, path: str) -> None:
+        if os.path.isdir(path):
+            self.paths = sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            self.paths = [path]
+        if not self.paths:
+            raise FileNotFoundError(f"No images found in {path}")
+        # Frames are played in name order and the last one is held.
+        self.index = 0
+        self.loaded: tuple[str, np.ndarray] | None = None
+        self.clicks: list[tuple[float, float, str]] = []
+        self.buffers = BufferPool()
+
+    def screenshot(self, region: Region | None = None) -> np.ndarray:
+        path = self.paths[min(self.index, len(self.paths) - 1)]
+        self.index += 1
+        if self.loaded is None or self.loaded[0] != path:
+            image = cv.imread(path)
+            if image is None:
+                raise FileNotFoundError(f"Couldn't read {path}")
+            self.loaded = path, cv.cvtColor(image, cv.COLOR_BGR2RGB)
+        image = crop_region(self.loaded[1], region)
+        frame = self.buffers.get("frame", image.shape)
+        np.copyto(frame, image)
+        return frame
+
+    def click(self, x: float, y: float, button: str = "left") -> None:
+        self.clicks.append((x, y, button))
+
+
+class Capture:
+    def __init__(self, backend: Backend,
+                 margin: int = CAPTURE_MARGIN,
+                 right_half: bool = False,
+                 limit_region: bool = True) -> None:
+        self.backend = backend
+        self.margin = margin
+        self.right_half = right_half
+        self.limit_region = limit_region
+        self.screen: tuple[int, int] | None = None
+        self.region: Region | None = None
+        # A grabbed frame is overwritten by the next grab into the same
+        # buffer, so callers that keep frames pass their own buffer names.
+        self.buffers = BufferPool()
+
+    def base_region(self) -> Region | None:
+        if not self.right_half or self.screen is None:
+            return None
+        height, width = self.screen
+        return width // 2, 0, width - width // 2, height
+
+    def grab(self, buffer: str = "frame") -> tuple[np.ndarray, Offset]:
+        region = self.region or self.base_region()
+        image = self.backend.screenshot(region)
+        if region is None:
+            self.screen = image.shape[:2]
+            region = self.base_region()
+            image = crop_region(image, region)
+        image = cv.cvtColor(image, cv.COLOR_RGB2BGR,
+                            dst=self.buffers.get(buffer, image.shape))
+        return image, (0, 0) if region is None else region[:2]
+
+    def focus(self, field: tuple[Offset, Offset], offset: Offset) -> None:
+        # Once the minefield is known only it and a small margin are
+        # captured, keeping the probes just outside its edges in view.
+        if not self.limit_region or self.screen is None:
+            return
+        height, width = self.screen
+        (x_start, y_start), (x_end, y_end) = field
+        x_offset, y_offset = offset
+        left = max(0, x_offset + x_start - self.margin)
+        top = max(0, y_offset + y_start - self.margin)
+        right = min(width, x_offset + x_end + self.margin)
+        bottom = min(height, y_offset + y_end + self.margin)
+        self.region = left, top, right - left, bottom - top
+
+    def reset(self) -> bool:
+        # Back to the full capture area; returns whether it was limited.
+        limited = self.region is not None
+        self.region = None
+        return limited
+
+
+class FrameGrabber(threading.Thread):
+    def __init__(self, capture: Capture,
+                 metrics: Metrics = NO_METRICS) -> None:
+        super().__init__(daemon=True)
+        self.capture = capture
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.running = True
+        # Every capture gets a ticket when it starts, so callers can tell
+        # whether a frame was taken after something they did.
+        self.started = 0
+        self.ticket = 0
+        self.frame: np.ndarray | None = None
+        self.offset: Offset = (0, 0)
+        # Three buffers take turns: the latest frame, the one the caller
+        # is still analyzing and the one being captured.
+        self.buffer = 0
+        self.held = -1
+
+    def run(self) -> None:
+        while self.running:
+            with self.condition:
+                self.started += 1
+                ticket = self.started
+                buffer = next(index for index in range(3)
+                              if index not in (self.buffer, self.held))
+            with self.metrics.stage("capture"):
+                frame, offset = self.capture.grab(f"grabber{buffer}")
+            with self.condition:
+                self.ticket, self.frame, self.offset = ticket, frame, offset
+                self.buffer = buffer
+                self.condition.notify_all()
+
+    def latest(self, after: int = 0, timeout: float | None = None) \
+            -> tuple[int, np.ndarray | None, Offset]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.ticket > after, timeout)
+            if self.ticket <= after:
+                return after, None, self.offset
+            self.held = self.buffer
+            return self.ticket, self.frame, self.offset
+
+    def stop(self) -> None:
+        self.running = False
+        self.join()
+
+
+def load_backend() -> Backend:
+    name = os.getenv("BACKEND", "screen")
+    if name == "simulator":
+        from simulator import SimulatorBackend
+        seed = os.getenv("SIM_SEED")
+        return SimulatorBackend(int(os.getenv("SIM_ROWS", 16)),
+                                int(os.getenv("SIM_COLS", 30)),
+                                int(os.getenv("SIM_MINES", 99)),
+                                None if seed is None else int(seed),
+                                int(os.getenv("SIM_TILE_SIZE", 16)),
+                                boards=int(os.getenv("SIM_BOARDS", 1)))
+    if name == "file":
+        return FileBackend(os.getenv("CAPTURE_FILE", "screenshot.png"))
+    if name != "screen":
+        raise ValueError(f"Unknown backend: {name}")
+    return ScreenBackend(os.getenv("CAPTURE", "auto"))
+
+
+def load_capture(backend: Backend, right_half: bool = False) -> Capture:
+    return Capture(backend,
+                   int(os.getenv("CAPTURE_MARGIN", CAPTURE_MARGIN)),
+                   right_half,
+                   int(os.getenv("CAPTURE_REGION", 1)) != 0)
@@ -0,0 +1,473 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable
+import cv2 as cv
+import numpy as np
+from common import find_minefield_bounds, \
+    TILE_SYMBOLS, \
+    extract_grid_coordinates, \
+    parse_game_board, \
+    parse_game_state_tiles, \
+    GeometryCache, \
+    FrameParser
+from simulator import Game, \
+    Renderer, \
+    SimulatorBackend, \
+    tile_sprites, \
+    MAIN_COLOR, \
+    TILE_PADDING
+from probability import mine_probabilities, \
+    component_cache
+from propagation import labels_from_strings
+from backend import Region, \
+    Capture
+from parallel import ParallelSolver
+from solver import Solver, \
+    TIER_NAMES, \
+    solve_board
+from palette import PaletteProfile
+from service import BatchSolver, \
+    SolverServer
+import bot
+import hint
+
+# name -> (rows, cols, mines, tile size, repeats)
+BOARDS = {"beginner": (9, 9, 10, 16, 20),
+          "intermediate": (16, 16, 40, 16, 20),
+          "expert": (16, 30, 99, 16, 10),
+          "custom-200": (200, 200, 8250, 8, 3),
+          "custom-1000": (1000, 1000, 206250, 6, 1)}
+
+# The per-tile reference parser and the probability engine are too slow
+# to time on huge boards.
+REFERENCE_PARSE_LIMIT = 40000
+PROBABILITY_LIMIT = 40000
+# Smaller boards don't split into enough work to feed a process pool.
+PARALLEL_MIN_TILES = 40000
+
+STARTUP_RUNS = 5
+# Frames of the traced capture/overlay loop, after a few that settle the
+# capture region and fill the caches.
+MEMORY_FRAMES = 50
+MEMORY_WARMUP = 5
+
+# Service clients send these boards, built at several seeds, one request
+# at a time each.
+SERVICE_BOARDS = ("beginner", "intermediate", "expert")
+SERVICE_SEEDS = 16
+SERVICE_REQUESTS = 100
+
+SEED = 1234
+PROGRESS = 0.4
+
+
+class NullBackend:
+    tile_padding: int | None = None
+    field_padding: int | None = None
+
+    def __init__(self, screen: tuple[int, int] = (1080, 1920)) -> None:
+        self.screen = screen
+        self.clicks = 0
+
+    def screenshot(self, region: Region | None = None) -> np.ndarray:
+        height, width = self.screen
+        if region is not None:
+            _, _, width, height = region
+        return np.zeros((height, width, 3), dtype=np.uint8)
+
+    def click(self, x: float, y: float, button: str = "left") -> None:
+        self.clicks += 1
+
+
+def build_game(rows: int, cols: int, mines: int, seed: int) -> Game:
+    game = Game(rows, cols, mines, seed)
+    game.reveal(rows // 2, cols // 2)
+    rng = np.random.default_rng(seed)
+
+    # Open random safe tiles until the board is partly solved, then flag
+    # some of the mines that border the opened area.
+    target = PROGRESS * (rows * cols - mines)
+    for index in rng.permutation(rows * cols):
+        if game.revealed_count >= target:
+            break
+        y, x = divmod(int(index), cols)
+        if not game.mines[y, x]:
+            game.reveal(y, x)
+    padded = np.pad(game.revealed, 1)
+    near = np.zeros_like(game.revealed)
+    for i in range(3):
+        for j in range(3):
+            near |= padded[i:i + rows, j:j + cols]
+    game.flagged = game.mines & near & (rng.random((rows, cols)) < 0.5)
+    return game
+
+
+def measure(function: Callable[[], object], repeats: int) -> dict:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": statistics.median(times),
+            "min_ms": min(times),
+            "max_ms": max(times),
+            "runs": repeats}
+
+
+def benchmark_board(name: str, repeats: int | None = None,
+                    solver: ParallelSolver | None = None,
+                    budget: float | None = None) -> dict:
+    rows, cols, mines, tile_size, default_repeats = BOARDS[name]
+    repeats = repeats or default_repeats
+    game = build_game(rows, cols, mines, SEED)
+    renderer = Renderer(rows, cols, tile_size, right_half=False)
+    frame = renderer.render(game.visible(), game.state).copy()
+    field_padding = renderer.field_padding
+
+    # A second frame with one more tile opened, for the incremental parser.
+    covered = np.argwhere(~game.revealed & ~game.mines)
+    changed_game = build_game(rows, cols, mines, SEED)
+    if len(covered):
+        changed_game.revealed[tuple(covered[0])] = True
+    changed_frame = renderer.render(changed_game.visible(),
+                                    changed_game.state).copy()
+
+    field = find_minefield_bounds(frame, MAIN_COLOR)
+    grid = extract_grid_coordinates(frame, field, MAIN_COLOR,
+                                    TILE_PADDING, field_padding)
+    board, game_state = parse_game_board(frame, grid)
+    if game_state != game.minefield():
+        raise RuntimeError(f"{name}: parsed board doesn't match the game")
+    sprites = tile_sprites(tile_size)
+    palette = PaletteProfile.from_samples(
+        {symbol: [sprites[code]] for code, symbol in enumerate(TILE_SYMBOLS)})
+    if parse_game_board(frame, grid, palette.classify_grid)[1] != game_state:
+        raise RuntimeError(f"{name}: palette parse doesn't match")
+    bot_hint = bot.generate_hint_map(game_state)
+    hint_map = hint.generate_hint_map(game_state)
+    labels = labels_from_strings(hint_map)
+
+    geometry = GeometryCache()
+    geometry.lookup(frame, MAIN_COLOR, TILE_PADDING, field_padding)
+    handle, cache_path = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    GeometryCache(cache_path).lookup(frame, MAIN_COLOR, TILE_PADDING,
+                                     field_padding)
+    parser = FrameParser()
+    overlay = hint.OverlayRenderer()
+    frames = [frame, changed_frame]
+    parser.parse(frame, grid)
+
+    def parse_incremental() -> None:
+        frames.reverse()
+        parser.parse(frames[0], grid)
+
+    def first_frame(path: str | None) -> None:
+        # What a freshly started bot does before its first click.
+        _, first_grid = GeometryCache(path).lookup(
+            frame, MAIN_COLOR, TILE_PADDING, field_padding)
+        _, first_state, _ = FrameParser().parse(frame, first_grid)
+        bot.generate_hint_map(first_state)
+
+    def probabilities() -> None:
+        component_cache.clear()
+        mine_probabilities(board, labels, mines)
+
+    stages: dict[str, Callable[[], object]] = {
+        "bounds": lambda: find_minefield_bounds(frame, MAIN_COLOR),
+        "grid": lambda: extract_grid_coordinates(
+            frame, field, MAIN_COLOR, TILE_PADDING, field_padding),
+        "geometry_cached": lambda: geometry.lookup(
+            frame, MAIN_COLOR, TILE_PADDING, field_padding),
+        "geometry_warm": lambda: GeometryCache(cache_path).lookup(
+            frame, MAIN_COLOR, TILE_PADDING, field_padding),
+        "first_frame_cold": lambda: first_frame(None),
+        "first_frame_warm": lambda: first_frame(cache_path),
+        "parse": lambda: parse_game_board(frame, grid),
+        "parse_palette": lambda: parse_game_board(frame, grid,
+                                                  palette.classify_grid),
+        "parse_incremental": parse_incremental,
+        "solve": lambda: bot.generate_hint_map(game_state),
+        "solve_hint": lambda: hint.generate_hint_map(game_state),
+        "overlay": lambda: hint.OverlayRenderer().render(
+            frame, hint_map, grid, field),
+        "overlay_incremental": lambda: overlay.render(
+            frame, hint_map, grid, field),
+        "clicks": lambda: bot.apply_clicks(board, bot_hint, grid, None,
+                                           NullBackend(), 1, 0),
+    }
+    if rows * cols <= PROBABILITY_LIMIT:
+        stages["probabilities"] = probabilities
+    if rows * cols <= REFERENCE_PARSE_LIMIT:
+        stages["parse_reference"] = \
+            lambda: parse_game_state_tiles(frame, grid)
+    if solver is not None and rows * cols >= PARALLEL_MIN_TILES:
+        parallel = Solver(parallel=solver)
+        # Also starts the pool, so its startup isn't timed.
+        if bot.generate_hint_map(game_state, parallel) != bot_hint:
+            raise RuntimeError(f"{name}: parallel solve doesn't match")
+        stages["solve_parallel"] = \
+            lambda: bot.generate_hint_map(game_state, parallel)
+    if budget is not None:
+        budgeted = Solver(budget)
+        stages["solve_budget"] = \
+            lambda: bot.generate_hint_map(game_state, budgeted)
+
+    results = {"rows": rows, "cols": cols, "mines": mines,
+               "tile_size": tile_size, "stages": {}}
+    for stage, function in stages.items():
+        results["stages"][stage] = measure(function, repeats)
+        print(f"{name:>13} {stage:>19} "
+              f"{results['stages'][stage]['median_ms']:10.3f} ms")
+    os.remove(cache_path)
+
+    solution = solve_board(board, check_flags=False)
+    results["tiers"] = {name: int(np.count_nonzero(solution.tiers == tier))
+                        for tier, name in TIER_NAMES.items()}
+    print(f"{name:>13} {'labels by tier':>19} " + ", ".join(
+        f"{count} {tier}" for tier, count in results["tiers"].items()))
+    if budget is not None:
+        cut = solve_board(board, budget, check_flags=False)
+        results["budget"] = {
+            "budget_ms": budget * 1000,
+            "complete": cut.complete,
+            "labels": int(np.count_nonzero(cut.tiers)),
+            "unlimited_labels": int(np.count_nonzero(solution.tiers))}
+        print(f"{name:>13} {'within budget':>19} "
+              f"{results['budget']['labels']} of "
+              f"{results['budget']['unlimited_labels']} labels "
+              f"({'complete' if cut.complete else 'cut short'})")
+    if "solve_parallel" in results["stages"]:
+        speedup = results["stages"]["solve"]["median_ms"] / \
+            results["stages"]["solve_parallel"]["median_ms"]
+        print(f"{name:>13} {'parallel speedup':>19} {speedup:10.2f} x "
+              f"({solver.workers} workers)")
+    return results
+
+
+def benchmark_startup(runs: int = STARTUP_RUNS) -> dict:
+    # Each import runs in a fresh interpreter, as it does on launch.
+    results = {}
+    for module in ("bot", "hint"):
+        times = []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c",
+                 "import time\n"
+                 "start = time.perf_counter()\n"
+                 f"import {module}\n"
+                 "print(time.perf_counter() - start)"],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            times.append(float(output) * 1000)
+        results[f"import_{module}"] = {"median_ms": statistics.median(times),
+                                       "min_ms": min(times),
+                                       "max_ms": max(times),
+                                       "runs": runs}
+        print(f"{'startup':>13} {'import ' + module:>19} "
+              f"{results[f'import_{module}']['median_ms']:10.3f} ms")
+    return results
+
+
+def benchmark_memory(name: str, frames: int = MEMORY_FRAMES) -> dict:
+    # What hint.py does with every frame that needs detection and an
+    # overlay: capture, color conversion, masking, parsing and blending.
+    rows, cols, mines, tile_size, _ = BOARDS[name]
+    backend = SimulatorBackend(rows, cols, mines, SEED, tile_size)
+    capture = Capture(backend, right_half=True)
+    geometry = GeometryCache()
+    parser = FrameParser()
+    overlay = hint.OverlayRenderer()
+    hint_maps: list[list[str]] = []
+
+    def frame() -> np.ndarray:
+        image, offset = capture.grab()
+        find_minefield_bounds(image, MAIN_COLOR)
+        field, grid = geometry.lookup(image, MAIN_COLOR, TILE_PADDING,
+                                      backend.field_padding)
+        capture.focus(field, offset)
+        _, game_state, _ = parser.parse(image, grid)
+        if not hint_maps:
+            hint_maps.append(hint.generate_hint_map(game_state))
+        overlay.render(image, hint_maps[0], grid, field)
+        return image
+
+    for _ in range(MEMORY_WARMUP):
+        image = frame()
+    allocations = capture.buffers.allocations + backend.buffers.allocations
+    transient = []
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        frame()
+        transient.append(tracemalloc.get_traced_memory()[1] - before)
+    growth = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    results = {"frames": frames,
+               "frame_kb": image.nbytes / 1024,
+               "transient_kb": statistics.median(transient) / 1024,
+               "max_transient_kb": max(transient) / 1024,
+               "growth_kb": growth / 1024,
+               "buffers_allocated": capture.buffers.allocations +
+               backend.buffers.allocations - allocations}
+    print(f"{name:>13} {'frame memory':>19} "
+          f"{results['transient_kb']:10.1f} KB per frame "
+          f"({results['frame_kb']:.0f} KB frames), "
+          f"{results['growth_kb']:.1f} KB growth and "
+          f"{results['buffers_allocated']} buffers allocated over "
+          f"{frames} frames")
+    return results
+
+
+def benchmark_service(clients: int, workers: int,
+                      requests: int = SERVICE_REQUESTS) -> dict:
+    lines = []
+    for index in range(SERVICE_SEEDS * len(SERVICE_BOARDS)):
+        rows, cols, mines, _, _ = BOARDS[
+            SERVICE_BOARDS[index % len(SERVICE_BOARDS)]]
+        game = build_game(rows, cols, mines, SEED + index)
+        lines.append(json.dumps({"id": index,
+                                 "board": game.minefield()}).encode() + b"\n")
+
+    solver = BatchSolver(workers)
+    server = SolverServer(0, solver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    latencies: list[float] = []
+    errors = []
+
+    def client(offset: int) -> None:
+        with socket.create_connection(server.server_address) as connection, \
+                connection.makefile("rb") as responses:
+            for index in range(requests):
+                start = time.perf_counter()
+                connection.sendall(lines[(offset + index) % len(lines)])
+                response = json.loads(responses.readline())
+                latencies.append((time.perf_counter() - start) * 1000)
+                if "error" in response:
+                    errors.append(response["error"])
+
+    threads = [threading.Thread(target=client, args=(number * 7,))
+               for number in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    solver.close()
+
+    p50, p95, p99 = np.percentile(latencies, (50, 95, 99)).tolist()
+    results = {"clients": clients,
+               "workers": workers,
+               "boards": len(latencies),
+               "errors": len(errors),
+               "boards_per_s": len(latencies) / seconds,
+               "p50_ms": p50,
+               "p95_ms": p95,
+               "p99_ms": p99,
+               "mean_batch": solver.boards / max(solver.batches, 1)}
+    print(f"{'service':>13} {f'{clients} clients':>19} "
+          f"{results['boards_per_s']:10.1f} boards/s, p50 {p50:.2f} ms, "
+          f"p95 {p95:.2f} ms, p99 {p99:.2f} ms, "
+          f"{results['mean_batch']:.1f} boards per batch")
+    return results
+
+
+def compare(old: dict, new: dict) -> None:
+    print(f"{'board':>13} {'stage':>19} {'old ms':>10} {'new ms':>10} "
+          f"{'ratio':>7}")
+    for name, board in new["boards"].items():
+        old_board = old["boards"].get(name)
+        if old_board is None:
+            continue
+        for stage, result in board["stages"].items():
+            old_result = old_board["stages"].get(stage)
+            if old_result is None:
+                continue
+            before, after = old_result["median_ms"], result["median_ms"]
+            ratio = after / before if before else float("inf")
+            print(f"{name:>13} {stage:>19} {before:10.3f} {after:10.3f} "
+                  f"{ratio:7.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the capture/solve/click pipeline "
+                    "on fixed-seed simulated boards.")
+    parser.add_argument("--boards", nargs="+", choices=list(BOARDS),
+                        default=list(BOARDS))
+    parser.add_argument("--repeats", type=int, default=None,
+                        help="runs per stage (default depends on size)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes for the parallel solve stage "
+                             "(default: one per CPU, 0 to skip it)")
+    parser.add_argument("--startup", action="store_true",
+                        help="also time importing bot.py and hint.py in "
+                             "fresh interpreters")
+    parser.add_argument("--service", type=int, nargs="+", metavar="CLIENTS",
+                        help="also load the solver service with this many "
+                             "concurrent clients (several counts allowed)")
+    parser.add_argument("--budget", type=float, default=None, metavar="MS",
+                        help="also time solving with this budget and count "
+                             "the labels it reaches")
+    parser.add_argument("--memory", action="store_true",
+                        help="also trace the memory each frame of the "
+                             "capture and overlay loop allocates")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "opencv": cv.__version__,
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                        "seed": SEED},
+               "boards": {}}
+    solver = ParallelSolver(args.workers) if args.workers != 0 else None
+    if args.startup:
+        results["startup"] = benchmark_startup()
+    for name in args.boards:
+        results["boards"][name] = benchmark_board(
+            name, args.repeats, solver,
+            args.budget / 1000 if args.budget is not None else None)
+    if solver is not None:
+        solver.close()
+    if args.memory:
+        results["memory"] = {name: benchmark_memory(name)
+                             for name in args.boards}
+    if args.service:
+        workers = args.workers if args.workers is not None \
+            else os.cpu_count() or 1
+        results["service"] = {str(clients): benchmark_service(clients,
+                                                               workers)
+                              for clients in args.service}
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {args.output}.")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,153 +1,794 @@
 from dotenv import load_dotenv
 import os
+import threading
 import time
-import cv2 as cv
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, \
+    NamedTuple
 import numpy as np
-import pyautogui
-from common import find_minefield_bounds, \
-    extract_grid_coordinates, \
-    parse_game_state, \
-    get_neighbors
+from backend import Backend, \
+    Capture, \
+    FrameGrabber, \
+    load_backend, \
+    load_capture
+from common import GeometryCache, \
+    MultiGeometryCache, \
+    GEOMETRY_CACHE, \
+    Classifier, \
+    FrameParser, \
+    board_from_strings, \
+    offset_grid, \
+    UNKNOWN_TILE, \
+    FLAG_TILE
+from propagation import labels_to_strings, \
+    labels_from_strings, \
+    NO_LABEL
+from probability import mine_probabilities, \
+    lowest_risk_tile
+from recording import Recorder, \
+    load_recorder
+from solver import Solver, \
+    UNLIMITED, \
+    load_solver
+from palette import load_classifier
+from metrics import Metrics, \
+    NO_METRICS, \
+    load_metrics
+from session import GameResult, \
+    GameTracker, \
+    SessionStats, \
+    face_box, \
+    face_center, \
+    load_session, \
+    STUCK
+from planner import Point, \
+    plan_chords, \
+    plan_tour, \
+    travel_distance
 
 Position = tuple[int, int]
 Color = tuple[int, int, int]
-HintChange = tuple[Position, str]
 GridCoords = tuple[list[int], list[int]]
+Field = tuple[Position, Position]
+Action = tuple[int, int, str]
+
+# How long a restart may take to show a new game, and how often to look.
+RESTART_TIMEOUT = 5.0
+RESTART_POLL = 0.05
 
-UNCLICKABLE = "0"
 EMPTY = "1"
 SAFE = "2"
 DANGEROUS = "3"
 
 
-def analyze_tile_neighbors(tile_index: tuple[int, int],
-                           minefield: list[str],
-                           hint: list[str]) -> list[HintChange]:
-    y, x = tile_index
-    neighbours = get_neighbors(tile_index, minefield)
-    changes: list[HintChange] = []
-    num_mines = int(minefield[y][x])
-
-    num_flags = sum(1 for i, j in neighbours if minefield[i][j] == "F")
-    num_unknowns = sum(1 for i, j in neighbours if minefield[i][j] == "?")
-    num_dangerous = sum(1 for i, j in neighbours if hint[i][j] == DANGEROUS)
-    num_safe = sum(1 for i, j in neighbours if hint[i][j] == SAFE)
-    num_correct_flags = sum(1 for i, j in neighbours if
-                            hint[i][j] == UNCLICKABLE and
-                            minefield[i][j] == "F")
-
-    if num_correct_flags == num_mines:
-        changes.extend(((i, j), SAFE) for i, j in neighbours if
-                       minefield[i][j] == "?" and hint[i][j] != SAFE)
-    if num_correct_flags + num_dangerous == num_mines:
-        changes.extend(((i, j), SAFE) for i, j in neighbours if
-                       minefield[i][j] == "?" and
-                       hint[i][j] in {EMPTY, UNCLICKABLE})
-    if num_unknowns - num_safe + num_flags == num_mines:
-        changes.extend(((i, j), DANGEROUS) for i, j in neighbours if
-                       minefield[i][j] == "?" and
-                       hint[i][j] in {EMPTY, UNCLICKABLE})
-    return changes
-
-
-def generate_hint_map(minefield: list[str]) -> list[str]:
-    hint = [len(row) * UNCLICKABLE for row in minefield]
-    non_important = {"?", "0", "F"}
-    change_count = 1
-    while change_count > 0:
-        change_count = 0
-        for y, row in enumerate(minefield):
-            for x, tile in enumerate(row):
-                if tile not in non_important:
-                    changes = analyze_tile_neighbors((y, x), minefield, hint)
-                    for (i, j), new_label in changes:
-                        hint[i] = hint[i][:j] + new_label + hint[i][j + 1:]
-                        change_count += 1
-                if minefield[y][x] == "?" and hint[y][x] == UNCLICKABLE:
-                    hint[y] = hint[y][:x] + EMPTY + hint[y][x + 1:]
-    return hint
-
-
-def apply_clicks(hint: list[str],
+class ClickBatch(NamedTuple):
+    actions: list[Action]
+    points: np.ndarray
+    travel: float
+    row_major_travel: float
+    dropped: int = 0
+
+
+def generate_hint_map(minefield: list[str],
+                      solver: Solver = UNLIMITED) -> list[str]:
+    board = board_from_strings(minefield)
+    labels = solver.solve(board, check_flags=False).labels
+    labels[(board == UNKNOWN_TILE) & (labels == NO_LABEL)] = int(EMPTY)
+    return labels_to_strings(labels)
+
+
+def choose_guess(board: np.ndarray,
+                 hint: list[str],
+                 total_mines: int | None) -> Position | None:
+    labels = labels_from_strings(hint)
+    probabilities = mine_probabilities(board, labels, total_mines)
+    # Known mines left unflagged aren't candidates.
+    probabilities[labels == int(DANGEROUS)] = np.nan
+    return lowest_risk_tile(board, probabilities)
+
+
+def plan_clicks(board: np.ndarray,
+                hint: list[str],
+                guess: Position | None,
+                place_flags: bool = True,
+                pending: set[Position] = frozenset()) -> list[Action]:
+    labels = labels_from_strings(hint)
+    unknown = board == UNKNOWN_TILE
+    safe = unknown & (labels == int(SAFE))
+    mines = unknown & (labels == int(DANGEROUS))
+    flags = board == FLAG_TILE
+    if place_flags:
+        flags = flags | mines
+    for y, x in pending:
+        safe[y, x] = mines[y, x] = False
+
+    chords, opened = plan_chords(board, safe, flags)
+    actions: list[Action] = []
+    if place_flags:
+        actions += [(y, x, "right") for y, x in np.argwhere(mines).tolist()]
+    actions += [(y, x, "chord") for y, x in chords if (y, x) not in pending]
+    actions += [(y, x, "left")
+                for y, x in np.argwhere(safe & ~opened).tolist()]
+
+    if not actions and guess is not None:
+        actions.append((*guess, "left"))
+    return actions
+
+
+def tile_center(action: Action,
+                field_grid: GridCoords,
+                screen_scaling: float) -> Point:
+    x_coords, y_coords = field_grid
+    tile_size = x_coords[1] - x_coords[0]
+    y_idx, x_idx, _ = action
+    return ((x_coords[x_idx] + tile_size // 2) / screen_scaling,
+            (y_coords[y_idx] + tile_size // 2) / screen_scaling)
+
+
+def order_clicks(actions: list[Action],
                  field_grid: GridCoords,
-                 random_click: bool,
+                 screen_scaling: float,
+                 start: Point | None = None) -> ClickBatch:
+    points = np.array([tile_center(action, field_grid, screen_scaling)
+                       for action in actions], dtype=np.float64)
+    points = points.reshape(-1, 2)
+    row_major = np.arange(len(actions))
+
+    # Flags go first so chords relying on them find them in place.
+    flagging = np.array([action[2] == "right" for action in actions],
+                        dtype=bool)
+    order = np.zeros(0, dtype=np.intp)
+    position = start
+    for stage in (np.flatnonzero(flagging), np.flatnonzero(~flagging)):
+        if len(stage) == 0:
+            continue
+        order = np.concatenate(
+            [order, stage[plan_tour(points[stage], position)]])
+        position = tuple(points[order[-1]])
+    return ClickBatch([actions[i] for i in order], points[order],
+                      travel_distance(points, order, start),
+                      travel_distance(points, row_major, start))
+
+
+def click_tile(action: Action,
+               field_grid: GridCoords,
+               backend: Backend,
+               screen_scaling: float) -> None:
+    x, y = tile_center(action, field_grid, screen_scaling)
+    # Both Minesweeper Online and the simulator chord on a left click.
+    backend.click(x, y, button="right" if action[2] == "right" else "left")
+
+
+def tile_checker(capture: Capture,
+                 parser: FrameParser,
+                 screen_grid: GridCoords) -> Callable[[Action], bool]:
+    def is_stale(action: Action) -> bool:
+        # A tile opened by an earlier click's cascade, or already flagged,
+        # must not be clicked again, nor a number with nothing to open.
+        image, (x_offset, y_offset) = capture.grab()
+        grid = offset_grid(screen_grid, (-x_offset, -y_offset))
+        board = parser.parse(image, grid)[0]
+        y, x, button = action
+        if button == "chord":
+            return not np.any(board[max(y - 1, 0):y + 2,
+                                    max(x - 1, 0):x + 2] == UNKNOWN_TILE)
+        return board[y, x] != UNKNOWN_TILE
+    return is_stale
+
+
+def apply_clicks(board: np.ndarray,
+                 hint: list[str],
+                 field_grid: GridCoords,
+                 guess: Position | None,
+                 backend: Backend,
                  screen_scaling: float,
                  click_delay: float,
-                 turbo_mode: bool) -> True:
-    x_coords, y_coords = field_grid
-    tile_size = field_grid[0][1] - field_grid[0][0]
-    click = False
+                 place_flags: bool = True,
+                 start: Point | None = None,
+                 is_stale: Callable[[Action], bool] | None = None) \
+        -> ClickBatch:
+    batch = order_clicks(plan_clicks(board, hint, guess, place_flags),
+                         field_grid, screen_scaling, start)
+    dropped = 0
+    for action in batch.actions:
+        if is_stale is not None and is_stale(action):
+            dropped += 1
+            continue
+        click_tile(action, field_grid, backend, screen_scaling)
+        time.sleep(click_delay)
+    return batch._replace(dropped=dropped)
+
 
-    for y_idx, y in enumerate(y_coords[:-1]):
-        for x_idx, x in enumerate(x_coords[:-1]):
-            label = hint[y_idx][x_idx]
-            if label == UNCLICKABLE or (label == EMPTY and not random_click):
+def report_batch(batch: ClickBatch) -> None:
+    if not batch.actions:
+        return
+    message = f"Batch: {len(batch.actions)} actions, " \
+        f"{batch.travel:.0f} px travel " \
+        f"({batch.row_major_travel:.0f} px in row-major order)"
+    if batch.dropped:
+        message += f", {batch.dropped} stale actions skipped"
+    print(message + ".")
+
+
+class ClickWorker(threading.Thread):
+    def __init__(self,
+                 backend: Backend,
+                 grabber: FrameGrabber,
+                 screen_scaling: float,
+                 click_delay: float,
+                 metrics: Metrics = NO_METRICS) -> None:
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.metrics = metrics
+        self.grabber = grabber
+        self.screen_scaling = screen_scaling
+        self.click_delay = click_delay
+        self.condition = threading.Condition()
+        self.running = True
+        self.busy = False
+        self.plan: tuple[int, GridCoords, list[Action]] | None = None
+        # Tile -> last capture ticket started before its click finished.
+        # Frames with a higher ticket already show the click's effect.
+        self.issued: dict[Position, int] = {}
+        self.last_issued = 0
+        self.position: Point | None = None
+        self.clicks = 0
+        self.dropped = 0
+
+    def submit(self, ticket: int, grid: GridCoords,
+               actions: list[Action]) -> None:
+        with self.condition:
+            self.plan = (ticket, grid, actions)
+            self.condition.notify_all()
+
+    def pending(self, ticket: int) -> set[Position]:
+        with self.condition:
+            return {tile for tile, issued in self.issued.items()
+                    if issued >= ticket}
+
+    def idle(self) -> bool:
+        with self.condition:
+            return self.plan is None and not self.busy
+
+    def settled(self, ticket: int) -> bool:
+        with self.condition:
+            return self.plan is None and not self.busy and \
+                ticket > self.last_issued
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.plan is not None or not self.running)
+                if not self.running:
+                    return
+                ticket, grid, actions = self.plan
+                self.plan = None
+                self.busy = True
+
+            for index, action in enumerate(actions):
+                with self.condition:
+                    if not self.running:
+                        # The game is over; the rest of the plan belongs
+                        # to a board that is gone.
+                        self.dropped += len(actions) - index
+                        break
+                    if self.plan is not None:
+                        # A newer frame has been analyzed; its plan
+                        # replaces whatever is left of this one.
+                        self.dropped += len(actions) - index
+                        break
+                    if self.issued.get(action[:2], -1) >= ticket:
+                        self.dropped += 1
+                        continue
+                with self.metrics.stage("click"):
+                    click_tile(action, grid, self.backend,
+                               self.screen_scaling)
+                with self.condition:
+                    self.position = tile_center(action, grid,
+                                                self.screen_scaling)
+                    self.issued[action[:2]] = self.grabber.started
+                    self.last_issued = self.grabber.started
+                    self.clicks += 1
+                time.sleep(self.click_delay)
+
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.join()
+
+
+def run_pipelined(backend: Backend,
+                  capture: Capture,
+                  geometry: GeometryCache,
+                  parser: FrameParser,
+                  main_color: Color,
+                  tile_padding: int,
+                  field_padding: int,
+                  screen_scaling: float,
+                  click_delay: float,
+                  place_flags: bool,
+                  total_mines: int | None,
+                  recorder: Recorder | None,
+                  solver: Solver,
+                  metrics: Metrics,
+                  tracker: GameTracker) -> GameResult:
+    started = time.perf_counter()
+    grabber = FrameGrabber(capture, metrics)
+    worker = ClickWorker(backend, grabber, screen_scaling, click_delay,
+                         metrics)
+    grabber.start()
+    worker.start()
+
+    ticket = 0
+    frames = 0
+    guesses = 0
+    outcome = STUCK
+    last_grid = None
+    submitted: set[Action] = set()
+    while True:
+        metrics.frame()
+        with metrics.stage("wait"):
+            ticket, screenshot, offset = grabber.latest(ticket)
+        frames += 1
+        with metrics.stage("geometry"):
+            field, grid = geometry.lookup(
+                screenshot, main_color, tile_padding, field_padding)
+        if field is None or grid is None:
+            if capture.reset():
                 continue
-            click = True
-            if label == EMPTY:
-                pyautogui.click((x + tile_size // 2) / screen_scaling,
-                                (y + tile_size // 2) / screen_scaling)
-                random_click = False
-                if not turbo_mode:
-                    return True
-                time.sleep(click_delay)
-            if label == SAFE:
-                pyautogui.click((x + tile_size // 2) / screen_scaling,
-                                (y + tile_size // 2) / screen_scaling)
-                if not turbo_mode:
-                    return True
-                time.sleep(click_delay)
-            if label == DANGEROUS:
-                pyautogui.click((x + tile_size // 2) / screen_scaling,
-                                (y + tile_size // 2) / screen_scaling,
-                                button="right")
-                if not turbo_mode:
-                    return True
-                time.sleep(click_delay)
-                return True
-    return click
+            print("Coudn't find the minefield. Trying again in 1 second.")
+            time.sleep(1)
+            continue
+        capture.focus(field, offset)
+        screen_grid = offset_grid(grid, offset)
+        if screen_grid != last_grid:
+            # Remembered clicks refer to the old layout.
+            with worker.condition:
+                worker.issued.clear()
+            last_grid = screen_grid
+        with metrics.stage("parse"):
+            board, game_state, _ = parser.parse(screenshot, grid)
+        result = tracker.update(screenshot, field, grid, board)
+        if result is not None:
+            outcome = result
+            break
+        with metrics.stage("solve"):
+            hint = generate_hint_map(game_state, solver)
+        if recorder is not None:
+            with metrics.stage("record"):
+                recorder.write(board, labels_from_strings(hint), grid,
+                               screenshot)
 
+        with metrics.stage("plan"):
+            actions = plan_clicks(board, hint, None, place_flags,
+                                  worker.pending(ticket))
+        if not actions:
+            # Only guess once every click shows up in the frame.
+            if not worker.settled(ticket):
+                continue
+            with metrics.stage("guess"):
+                guess = choose_guess(board, hint, total_mines)
+            if guess is None:
+                break
+            guesses += 1
+            actions = [(*guess, "left")]
+        if set(actions) == submitted and not worker.idle():
+            # The plan in progress already covers this frame.
+            continue
+        if actions:
+            submitted = set(actions)
+            with metrics.stage("plan"):
+                batch = order_clicks(actions, screen_grid, screen_scaling,
+                                     worker.position)
+            report_batch(batch)
+            worker.submit(ticket, screen_grid, batch.actions)
 
-def main() -> None:
-    load_dotenv("config.env")
+    worker.stop()
+    grabber.stop()
+    print(f"Pipeline: {grabber.ticket} frames captured, {frames} analyzed, "
+          f"{worker.clicks} clicks, {worker.dropped} stale actions dropped.")
+    return GameResult(outcome, time.perf_counter() - started, guesses,
+                      worker.clicks, frames)
 
-    screen_scaling = float(os.getenv("SCREEN_SCALING", 1))
-    main_color: Color = tuple(
-        map(int, os.getenv("MAIN_COLOR",
-                           "198,198,198").split(",")))   # type: ignore
-    click_delay = float(os.getenv("CLICK_DELAY", 1))
-    tile_padding = int(os.getenv("TILE_PADDING", 5))
-    field_padding = int(os.getenv("FIELD_PADDING", 12))
-    turbo_mode = int(os.getenv("TURBO_MODE", 0)) != 0
 
+def run_sequential(backend: Backend,
+                   capture: Capture,
+                   geometry: GeometryCache,
+                   parser: FrameParser,
+                   main_color: Color,
+                   tile_padding: int,
+                   field_padding: int,
+                   screen_scaling: float,
+                   click_delay: float,
+                   turbo_mode: bool,
+                   verify_clicks: bool,
+                   place_flags: bool,
+                   total_mines: int | None,
+                   recorder: Recorder | None,
+                   solver: Solver,
+                   metrics: Metrics,
+                   tracker: GameTracker) -> GameResult:
+    started = time.perf_counter()
+    frames = guesses = clicks = 0
+    outcome = STUCK
+    position = None
     last_click = True
     click = True
     while last_click or click:
-        screenshot = np.array(pyautogui.screenshot())
-        screenshot = cv.cvtColor(screenshot, cv.COLOR_RGB2BGR)
+        metrics.frame()
+        frames += 1
+        with metrics.stage("capture"):
+            screenshot, offset = capture.grab()
 
-        field = find_minefield_bounds(screenshot, main_color)
+        with metrics.stage("geometry"):
+            field, grid = geometry.lookup(
+                screenshot, main_color, tile_padding, field_padding)
+        if (field is None or grid is None) and capture.reset():
+            continue
         if field is None:
             print("Coudn't find the minefield. Trying again in 1 second.")
             click = True
             time.sleep(1)
             continue
-        grid = extract_grid_coordinates(
-            screenshot, field, main_color, tile_padding, field_padding)
         if grid is None:
             print("Coudn't extract the grid coordinates. Trying again in 1 second.")
             click = True
             time.sleep(1)
             continue
-        game_state = parse_game_state(screenshot, grid)
-        hint = generate_hint_map(game_state)
+        capture.focus(field, offset)
+        with metrics.stage("parse"):
+            board, game_state, _ = parser.parse(screenshot, grid)
+        result = tracker.update(screenshot, field, grid, board)
+        if result is not None:
+            outcome = result
+            break
+        with metrics.stage("solve"):
+            hint = generate_hint_map(game_state, solver)
+        if recorder is not None:
+            with metrics.stage("record"):
+                recorder.write(board, labels_from_strings(hint), grid,
+                               screenshot)
 
         last_click = click
-        click = apply_clicks(
-            hint, grid, not last_click, screen_scaling, click_delay, turbo_mode)
+        guess = None
+        if not last_click:
+            with metrics.stage("guess"):
+                guess = choose_guess(board, hint, total_mines)
+        screen_grid = offset_grid(grid, offset)
+        is_stale = tile_checker(capture, parser, screen_grid) \
+            if verify_clicks else None
+        with metrics.stage("clicks"):
+            batch = apply_clicks(board, hint, screen_grid, guess, backend,
+                                 screen_scaling, click_delay, place_flags,
+                                 position, is_stale)
+        report_batch(batch)
+        click = bool(batch.actions)
+        if click:
+            position = tuple(batch.points[-1])
+            clicks += len(batch.actions) - batch.dropped
+            # A guess is only clicked when nothing else was planned.
+            if guess is not None and batch.actions == [(*guess, "left")]:
+                guesses += 1
 
         if not turbo_mode:
             time.sleep(click_delay)
+    return GameResult(outcome, time.perf_counter() - started, guesses,
+                      clicks, frames)
+
+
+def restart_game(backend: Backend,
+                 capture: Capture,
+                 locate: Callable[[np.ndarray],
+                                  tuple[Field, GridCoords] | None],
+                 screen_scaling: float) -> bool:
+    screenshot, offset = capture.grab()
+    geometry = locate(screenshot)
+    center = None if geometry is None else face_center(*geometry)
+    if center is None:
+        return False
+    left, top, right, bottom = face_box(*geometry)
+    finished_face = screenshot[top:bottom, left:right].copy()
+    x, y = center
+    backend.click((x + offset[0]) / screen_scaling,
+                  (y + offset[1]) / screen_scaling)
+
+    # The next game may only start tracking once its face is up.
+    deadline = time.perf_counter() + RESTART_TIMEOUT
+    while time.perf_counter() < deadline:
+        screenshot, offset = capture.grab()
+        geometry = locate(screenshot)
+        box = None if geometry is None else face_box(*geometry)
+        if box is not None:
+            left, top, right, bottom = box
+            face = screenshot[top:bottom, left:right]
+            if face.shape != finished_face.shape or \
+                    not np.array_equal(face, finished_face):
+                return True
+        time.sleep(RESTART_POLL)
+    return False
+
+
+def start_new_game(backend: Backend,
+                   capture: Capture,
+                   geometry: GeometryCache,
+                   main_color: Color,
+                   tile_padding: int,
+                   field_padding: int,
+                   screen_scaling: float) -> bool:
+    def locate(screenshot: np.ndarray) -> tuple[Field, GridCoords] | None:
+        field, grid = geometry.lookup(
+            screenshot, main_color, tile_padding, field_padding)
+        return None if grid is None else (field, grid)
+
+    return restart_game(backend, capture, locate, screen_scaling)
+
+
+class BoardState:
+    def __init__(self, parser: FrameParser, tracker: GameTracker) -> None:
+        self.parser = parser
+        self.tracker = tracker
+        self.playing = True
+        self.new_game()
+
+    def new_game(self) -> None:
+        self.parser.reset()
+        self.tracker.reset()
+        self.started = time.perf_counter()
+        self.frames = self.guesses = self.clicks = 0
+        # As in run_sequential, a guess only follows a frame with nothing
+        # to click, and a second such frame leaves the game stuck.
+        self.click = True
+        self.last_click = True
+
+    def result(self, outcome: str) -> GameResult:
+        return GameResult(outcome, time.perf_counter() - self.started,
+                          self.guesses, self.clicks, self.frames)
+
+
+class BoardTurn(NamedTuple):
+    board: np.ndarray
+    hint: list[str]
+    guess: Position | None
+    outcome: str | None
+
+
+def analyze_board(state: BoardState,
+                  screenshot: np.ndarray,
+                  field: Field,
+                  grid: GridCoords,
+                  solver: Solver,
+                  total_mines: int | None,
+                  metrics: Metrics) -> BoardTurn:
+    state.frames += 1
+    with metrics.stage("parse"):
+        board, game_state, _ = state.parser.parse(screenshot, grid)
+    outcome = state.tracker.update(screenshot, field, grid, board)
+    if outcome is not None:
+        return BoardTurn(board, [], None, outcome)
+    with metrics.stage("solve"):
+        hint = generate_hint_map(game_state, solver)
+    state.last_click = state.click
+    guess = None
+    if not state.last_click:
+        with metrics.stage("guess"):
+            guess = choose_guess(board, hint, total_mines)
+    return BoardTurn(board, hint, guess, None)
+
+
+def field_union(fields: list[Field]) -> Field:
+    return (min(x for (x, _), _ in fields), min(y for (_, y), _ in fields)), \
+        (max(x for _, (x, _) in fields), max(y for _, (_, y) in fields))
+
+
+def run_boards(backend: Backend,
+               capture: Capture,
+               geometry: MultiGeometryCache,
+               classify: Classifier,
+               main_color: Color,
+               tile_padding: int,
+               field_padding: int,
+               screen_scaling: float,
+               click_delay: float,
+               turbo_mode: bool,
+               verify_clicks: bool,
+               place_flags: bool,
+               total_mines: int | None,
+               solver: Solver,
+               metrics: Metrics,
+               stats: SessionStats,
+               games: int,
+               deadline: float | None) -> None:
+    states: list[BoardState] = []
+    executor: ThreadPoolExecutor | None = None
+    started = 0
+    position = None
+
+    def locate(index: int) -> Callable[[np.ndarray],
+                                       tuple[Field, GridCoords] | None]:
+        def locate_board(screenshot: np.ndarray) \
+                -> tuple[Field, GridCoords] | None:
+            geometries = geometry.lookup(
+                screenshot, main_color, tile_padding, field_padding)
+            return geometries[index] if index < len(geometries) else None
+        return locate_board
+
+    while True:
+        metrics.frame()
+        with metrics.stage("capture"):
+            screenshot, offset = capture.grab()
+        with metrics.stage("geometry"):
+            geometries = geometry.lookup(
+                screenshot, main_color, tile_padding, field_padding)
+        if not geometries and capture.reset():
+            continue
+        if not geometries:
+            print("Coudn't find any minefield. Trying again in 1 second.")
+            time.sleep(1)
+            continue
+        if len(geometries) != len(states):
+            # Games in progress can't be matched to boards that came or
+            # went, so every board starts over.
+            states = [BoardState(FrameParser(classify),
+                                 GameTracker(total_mines))
+                      for _ in geometries]
+            started = len(states)
+            if games and started > games:
+                for state in states[games:]:
+                    state.playing = False
+                started = games
+            if executor is not None:
+                executor.shutdown()
+            executor = ThreadPoolExecutor(len(states))
+            print(f"Playing on {len(states)} minefields.")
+        capture.focus(field_union([field for field, _ in geometries]),
+                      offset)
+
+        active = [index for index, state in enumerate(states)
+                  if state.playing]
+        if not active:
+            break
+        # Boards are parsed and solved at once, then take turns clicking.
+        with metrics.stage("analyze"):
+            turns = list(executor.map(
+                lambda index: analyze_board(
+                    states[index], screenshot, *geometries[index], solver,
+                    total_mines, metrics),
+                active))
+
+        for index, turn in zip(active, turns):
+            state = states[index]
+            outcome = turn.outcome
+            if outcome is None:
+                screen_grid = offset_grid(geometries[index][1], offset)
+                is_stale = tile_checker(capture, state.parser, screen_grid) \
+                    if verify_clicks else None
+                with metrics.stage("clicks"):
+                    batch = apply_clicks(turn.board, turn.hint, screen_grid,
+                                         turn.guess, backend, screen_scaling,
+                                         click_delay, place_flags, position,
+                                         is_stale)
+                report_batch(batch)
+                state.click = bool(batch.actions)
+                if state.click:
+                    position = tuple(batch.points[-1])
+                    state.clicks += len(batch.actions) - batch.dropped
+                    if turn.guess is not None and \
+                            batch.actions == [(*turn.guess, "left")]:
+                        state.guesses += 1
+                if state.click or state.last_click:
+                    continue
+                outcome = STUCK
+
+            stats.add(state.result(outcome))
+            if (not games and deadline is None) or \
+                    (games and started >= games) or \
+                    (deadline is not None and
+                     time.perf_counter() >= deadline):
+                state.playing = False
+            elif restart_game(backend, capture, locate(index),
+                              screen_scaling):
+                started += 1
+                state.new_game()
+            else:
+                print(f"Coudn't start a new game on minefield {index + 1}.")
+                state.playing = False
+
+        if not turbo_mode:
+            time.sleep(click_delay)
+    if executor is not None:
+        executor.shutdown()
+
+
+def main() -> None:
+    load_dotenv("config.env")
+
+    screen_scaling = float(os.getenv("SCREEN_SCALING", 1))
+    main_color: Color = tuple(
+        map(int, os.getenv("MAIN_COLOR",
+                           "198,198,198").split(",")))   # type: ignore
+    click_delay = float(os.getenv("CLICK_DELAY", 1))
+    tile_padding = int(os.getenv("TILE_PADDING", 5))
+    field_padding = int(os.getenv("FIELD_PADDING", 12))
+    turbo_mode = int(os.getenv("TURBO_MODE", 0)) != 0
+    # Without turbo mode every click is checked against a fresh frame.
+    verify_clicks = int(os.getenv("VERIFY_CLICKS", 0)) != 0 or \
+        not turbo_mode
+    place_flags = int(os.getenv("PLACE_FLAGS", 1)) != 0
+    total_mines = int(os.getenv("TOTAL_MINES", 0)) or None
+    pipelined = int(os.getenv("PIPELINED", 0)) != 0
+    multi_board = int(os.getenv("MULTI_BOARD", 0)) != 0
+
+    backend = load_backend()
+    if backend.tile_padding is not None:
+        tile_padding = backend.tile_padding
+        field_padding = backend.field_padding
+    capture = load_capture(backend)
+    solver = load_solver()
+    metrics = load_metrics("bot")
+
+    games, minutes = load_session()
+    stats = SessionStats(os.getenv("SESSION_LOG", "") or None)
+    deadline = time.perf_counter() + minutes * 60 if minutes else None
+    if multi_board:
+        boards = MultiGeometryCache()
+        run_boards(backend, capture, boards, load_classifier(), main_color,
+                   tile_padding, field_padding, screen_scaling, click_delay,
+                   turbo_mode, verify_clicks, place_flags, total_mines,
+                   solver, metrics, stats, games, deadline)
+        stats.report()
+        stats.close()
+        metrics.close()
+        solver.report()
+        solver.close()
+        print(f"Geometry cache: {boards.hits} hits, {boards.misses} misses.")
+        return
+
+    recorder = load_recorder("bot")
+    geometry = GeometryCache(os.getenv("GEOMETRY_CACHE", GEOMETRY_CACHE)
+                             or None, (screen_scaling,))
+    parser = FrameParser(load_classifier())
+    tracker = GameTracker(total_mines)
+    while True:
+        tracker.reset()
+        if pipelined:
+            result = run_pipelined(
+                backend, capture, geometry, parser, main_color,
+                tile_padding, field_padding, screen_scaling, click_delay,
+                place_flags, total_mines, recorder, solver, metrics,
+                tracker)
+        else:
+            result = run_sequential(
+                backend, capture, geometry, parser, main_color,
+                tile_padding, field_padding, screen_scaling, click_delay,
+                turbo_mode, verify_clicks, place_flags, total_mines,
+                recorder, solver, metrics, tracker)
+        stats.add(result)
+        if not games and not minutes:
+            break
+        if games and len(stats.results) >= games:
+            break
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if not start_new_game(backend, capture, geometry, main_color,
+                              tile_padding, field_padding, screen_scaling):
+            print("Coudn't start a new game, stopping the session.")
+            break
+    stats.report()
+    stats.close()
+    metrics.close()
+    solver.report()
+    solver.close()
+    if recorder is not None:
+        recorder.close()
+        print(f"Recorded {recorder.frames} frames.")
+    print(f"Geometry cache: {geometry.hits} hits, {geometry.misses} misses, "
+          f"{geometry.restored} restored from disk.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,26 @@
+import threading
+import numpy as np
+
+
+class BufferPool:
+    def __init__(self) -> None:
+        # Every thread has its own buffers, so an array handed out stays
+        # untouched until the same thread asks for that name again.
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.allocations = 0
+
+    def get(self, name: str, shape: tuple[int, ...],
+            dtype: type = np.uint8) -> np.ndarray:
+        buffers: dict[str, np.ndarray] | None = \
+            getattr(self.local, "buffers", None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            # Only a new frame size, like a changed capture region, needs
+            # a new buffer.
+            buffer = buffers[name] = np.empty(shape, dtype)
+            with self.lock:
+                self.allocations += 1
+        return buffer
@@ -3,14 +3,22 @@ import os
 import time
 import cv2 as cv
 from cv2.typing import MatLike
-import numpy as np
-import pyautogui
-from common import find_minefield_bounds, \
-    extract_grid_coordinates
+from backend import load_backend, \
+    load_capture
+from common import GeometryCache, \
+    GEOMETRY_CACHE, \
+    classify_tile
+from palette import PaletteProfile
 
 Color = tuple[int, int, int]
 GridCoords = tuple[list[int], list[int]]
 
+PALETTE_PATH = "palette.json"
+PALETTE_KEYS = {ord(str(digit)): str(digit) for digit in range(9)} | \
+    {ord("u"): "?", ord("f"): "F"}
+MAX_SAMPLE_TILES = 40
+PREVIEW_SCALE = 8
+
 
 def draw_grid_overlay(image: MatLike, field_grid: GridCoords) -> MatLike:
     x_coords, y_coords = field_grid
@@ -25,6 +33,61 @@ def draw_grid_overlay(image: MatLike, field_grid: GridCoords) -> MatLike:
     return overlay
 
 
+def distinct_tiles(image: MatLike, field_grid: GridCoords) -> list[MatLike]:
+    x_coords, y_coords = field_grid
+    tile_size = y_coords[1] - y_coords[0]
+    tiles: dict[bytes, MatLike] = {}
+    counts: dict[bytes, int] = {}
+    for y in y_coords[:-1]:
+        for x in x_coords[:-1]:
+            tile = image[y:y + tile_size, x:x + tile_size]
+            key = tile.tobytes()
+            tiles.setdefault(key, tile)
+            counts[key] = counts.get(key, 0) + 1
+    keys = sorted(tiles, key=counts.get, reverse=True)[:MAX_SAMPLE_TILES]
+    return [tiles[key] for key in keys]
+
+
+def sample_palette(image: MatLike,
+                   field_grid: GridCoords) -> dict[str, list[MatLike]]:
+    samples: dict[str, list[MatLike]] = {}
+    tiles = distinct_tiles(image, field_grid)
+    for index, tile in enumerate(tiles):
+        suggestion = classify_tile(tile)
+        cv.imshow("Tile", cv.resize(tile, None, fx=PREVIEW_SCALE,
+                                    fy=PREVIEW_SCALE,
+                                    interpolation=cv.INTER_NEAREST))
+        print(f"Tile {index + 1}/{len(tiles)} looks like '{suggestion}': "
+              "press 0-8, u for covered or f for flag, Enter to accept, "
+              "Space to skip, Esc to stop.")
+        key = cv.waitKey(0)
+        if key == 27:  # Escape key
+            break
+        if key == 13:
+            symbol = suggestion
+        elif key in PALETTE_KEYS:
+            symbol = PALETTE_KEYS[key]
+        else:
+            continue
+        samples.setdefault(symbol, []).append(tile)
+    cv.destroyWindow("Tile")
+    return samples
+
+
+def save_palette(samples: dict[str, list[MatLike]]) -> None:
+    path = os.getenv("PALETTE", "") or PALETTE_PATH
+    # Symbols not sampled this time keep what an earlier run saved.
+    base = PaletteProfile.load(path) if os.path.exists(path) else None
+    profile = PaletteProfile.from_samples(samples, base)
+    profile.save(path)
+    set_key("config.env", "PALETTE", path)
+    missing = profile.missing()
+    print(f"Palette saved to {path}.")
+    if missing:
+        print(f"Not sampled yet: {' '.join(missing)}. Calibrate again "
+              "once they show up on the board.")
+
+
 def main() -> None:
     load_dotenv("config.env")
 
@@ -34,23 +97,27 @@ def main() -> None:
     tile_padding = int(os.getenv("TILE_PADDING", 5))
     field_padding = int(os.getenv("FIELD_PADDING", 12))
 
+    capture = load_capture(load_backend(), right_half=True)
+    # Only the geometry that is finally accepted gets saved.
+    geometry = GeometryCache(os.getenv("GEOMETRY_CACHE", GEOMETRY_CACHE)
+                             or None, autosave=False)
     while True:
-        screenshot = np.array(pyautogui.screenshot())
-        right_side = screenshot[:, len(screenshot[0]) // 2:]
-        right_side = cv.cvtColor(right_side, cv.COLOR_RGB2BGR)
+        right_side, offset = capture.grab()
 
-        field = find_minefield_bounds(right_side, main_color)
+        field, grid = geometry.lookup(
+            right_side, main_color, tile_padding, field_padding)
+        if field is None and capture.reset():
+            continue
         if field is None:
             print("Coudn't find the minefield. Trying again in 1 second.")
             time.sleep(1)
             continue
 
-        grid = extract_grid_coordinates(
-            right_side, field, main_color, tile_padding, field_padding)
         if grid is None:
             print("Coudn't extract the grid coordinates. Trying again in 1 second.")
             time.sleep(1)
             continue
+        capture.focus(field, offset)
 
         grid_overlay = draw_grid_overlay(right_side, grid)
         (x_start, y_start), (x_end, y_end) = field
@@ -67,9 +134,20 @@ def main() -> None:
             tile_padding -= 1
         elif key == ord('d'):
             tile_padding += 1
+        elif key == ord('p'):
+            samples = sample_palette(right_side, grid)
+            if samples:
+                save_palette(samples)
         elif key == 13:  # Enter key
             set_key("config.env", "TILE_PADDING", str(tile_padding))
             set_key("config.env", "FIELD_PADDING", str(field_padding))
+            # hint.py starts from a full capture, so that is the geometry
+            # it will find in the cache.
+            capture.reset()
+            image, _ = capture.grab()
+            if geometry.lookup(image, main_color, tile_padding,
+                               field_padding)[1] is not None:
+                geometry.remember()
             break
 
         print(f"Tile Padding: {tile_padding}, Field Padding: {field_padding}")
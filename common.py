@@ -1,28 +1,86 @@
+import json
+import os
+from typing import Callable
 import cv2 as cv
 from cv2.typing import MatLike
 import numpy as np
+from buffers import BufferPool
 
 Position = tuple[int, int]
 Color = tuple[int, int, int]
 GridCoords = tuple[list[int], list[int]]
+Classifier = Callable[[MatLike, int, int, int], np.ndarray]
 
 
 VICINITY = [(-1, 1), (0, 1), (1, 1),
             (-1, 0), (1, 0),
             (-1, -1), (0, -1), (1, -1)]
 
+TILE_SYMBOLS = "012345678?F"
+TILE_CODES = {symbol: code for code, symbol in enumerate(TILE_SYMBOLS)}
+UNKNOWN_TILE = TILE_CODES["?"]
+FLAG_TILE = TILE_CODES["F"]
+SYMBOL_TABLE = bytes.maketrans(bytes(range(len(TILE_SYMBOLS))),
+                               TILE_SYMBOLS.encode())
+CODE_TABLE = np.zeros(256, dtype=np.uint8)
+CODE_TABLE[np.frombuffer(TILE_SYMBOLS.encode(), dtype=np.uint8)] = \
+    np.arange(len(TILE_SYMBOLS), dtype=np.uint8)
+
+# Same windows as classify_tile, in the order it tests them.
+DIGIT_RANGES = [("1", (210, 0, 0), (255, 30, 30)),
+                ("2", (0, 90, 0), (30, 140, 30)),
+                ("4", (90, 0, 0), (140, 30, 30)),
+                ("6", (50, 50, 0), (170, 170, 40))]
+RED_RANGE = ((0, 0, 210), (30, 30, 255))
+FIVE_RANGE = ((0, 0, 50), (40, 40, 170))
+BLACK_RANGE = ((0, 0, 0), (50, 50, 50))
+WHITE_RANGE = ((230, 230, 230), (255, 255, 255))
+GRAY_RANGE = ((70, 70, 70), (180, 180, 180))
+
+# Counts the 8 tiles around each tile, with nothing beyond the border.
+NEIGHBOR_KERNEL = np.ones((3, 3), dtype=np.float32)
+NEIGHBOR_KERNEL[1, 1] = 0
+
+# Geometries kept on disk, most recently detected first.
+GEOMETRY_CACHE = "geometry_cache.json"
+GEOMETRY_ENTRIES = 8
+# Smallest width and height, in pixels, of a patch of the main color that
+# is taken for one of several minefields.
+MIN_FIELD_SIDE = 64
+
+# Masks are rebuilt on every detection; their buffers are kept.
+_buffers = BufferPool()
+
+
+def neighbor_counts(mask: np.ndarray) -> np.ndarray:
+    if mask.size == 0:
+        return np.zeros(mask.shape, dtype=np.uint8)
+    return cv.filter2D(np.asarray(mask, dtype=np.uint8), -1,
+                       NEIGHBOR_KERNEL, borderType=cv.BORDER_CONSTANT)
+
+
+def _main_color_mask(image: MatLike, main_color: Color,
+                     buffer: str) -> MatLike:
+    # Contours only see which pixels are set, so the mask is all they need.
+    color = np.array(main_color)
+    return cv.inRange(image, color, color,
+                      dst=_buffers.get(buffer, image.shape[:2]))
+
+
+def _field_contours(image: MatLike, main_color: Color) -> list:
+    mask = _main_color_mask(image, main_color, "field_mask")
+
+    # Minefields are always top-level contours, and building the full
+    # hierarchy gets very slow once a big board yields many contours.
+    contours, _ = cv.findContours(
+        mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    return contours
+
 
 def find_minefield_bounds(image: MatLike,
                           main_color: Color) \
         -> tuple[Position, Position] | None:
-    mask = cv.inRange(image, np.array(main_color), np.array(main_color))
-
-    masked_image = cv.bitwise_and(image, image, mask=mask)
-    grayscale_image = cv.cvtColor(masked_image, cv.COLOR_BGR2GRAY)
-
-    contours, _ = cv.findContours(
-        grayscale_image, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-
+    contours = _field_contours(image, main_color)
     if len(contours) == 0:
         return None
 
@@ -31,6 +89,19 @@ def find_minefield_bounds(image: MatLike,
     return (x, y), (x + w, y + h)
 
 
+def find_minefields(image: MatLike,
+                    main_color: Color,
+                    min_side: int = MIN_FIELD_SIDE) \
+        -> list[tuple[Position, Position]]:
+    fields = []
+    for contour in _field_contours(image, main_color):
+        x, y, w, h = cv.boundingRect(contour)
+        if w >= min_side and h >= min_side:
+            fields.append(((x, y), (x + w, y + h)))
+    # Reading order, so boards keep their numbers from frame to frame.
+    return sorted(fields, key=lambda field: (field[0][1], field[0][0]))
+
+
 def extract_grid_coordinates(image: MatLike,
                              minefield_position: tuple[Position, Position],
                              main_color: Color,
@@ -39,22 +110,16 @@ def extract_grid_coordinates(image: MatLike,
     (x_start, y_start), (x_end, y_end) = minefield_position
     image = image[y_start:y_end, x_start:x_end]
 
-    mask = cv.inRange(image, np.array(main_color), np.array(main_color))
-    masked_image = cv.bitwise_and(image, image, mask=mask)
-    grayscale_image = cv.cvtColor(masked_image, cv.COLOR_BGR2GRAY)
-
+    mask = _main_color_mask(image, main_color, "grid_mask")
     contours, _ = cv.findContours(
-        grayscale_image, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-
-    sorted_contours = sorted(contours, key=cv.contourArea, reverse=True)
+        mask, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
 
-    if len(sorted_contours) < 2:
+    if len(contours) < 2:
         return None
 
-    second_largest_contour_idx = next(
-        i for i, c in enumerate(contours) if
-        cv.contourArea(c) == cv.contourArea(sorted_contours[1])
-    )
+    areas = [cv.contourArea(c) for c in contours]
+    second_largest_area = sorted(areas, reverse=True)[1]
+    second_largest_contour_idx = areas.index(second_largest_area)
 
     second_largest_contour = contours[second_largest_contour_idx]
 
@@ -69,8 +134,7 @@ def extract_grid_coordinates(image: MatLike,
     if not child_contours:
         return None
 
-    child_index = max(
-        child_contours, key=lambda i: cv.contourArea(contours[i]))
+    child_index = max(child_contours, key=lambda i: areas[i])
 
     max_size = contours[child_index][2][0][0] - \
         contours[child_index][0][0][0]
@@ -90,6 +154,198 @@ def extract_grid_coordinates(image: MatLike,
     return x_cords, y_cords
 
 
+def offset_grid(field_grid: GridCoords,
+                offset: tuple[int, int]) -> GridCoords:
+    x_offset, y_offset = offset
+    x_coords, y_coords = field_grid
+    return [x + x_offset for x in x_coords], [y + y_offset for y in y_coords]
+
+
+class GeometryCache:
+    def __init__(self, path: str | None = None,
+                 context: tuple = (),
+                 autosave: bool = True) -> None:
+        self.key: tuple | None = None
+        self.field: tuple[Position, Position] | None = None
+        self.grid: GridCoords | None = None
+        self.probe_ys = np.zeros(0, dtype=np.intp)
+        self.probe_xs = np.zeros(0, dtype=np.intp)
+        self.probe_colors: np.ndarray | None = None
+        self.hits = 0
+        self.misses = 0
+        self.restored = 0
+        # Geometries detected in earlier runs. The key also holds whatever
+        # else the caller's coordinates depend on, like screen scaling.
+        self.path = path
+        self.context = list(context)
+        self.autosave = autosave
+        self.entries: list[dict] = self._load()
+
+    def _load(self) -> list[dict]:
+        if not self.path or not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path) as file:
+                return json.load(file)["entries"]
+        except (OSError, ValueError, KeyError):
+            # A damaged cache only costs one detection.
+            return []
+
+    def _stored_key(self, key: tuple) -> list:
+        shape, main_color, tile_padding, field_padding = key
+        return [list(shape), list(main_color), tile_padding, field_padding,
+                self.context]
+
+    def invalidate(self) -> None:
+        self.key = None
+        self.field = None
+        self.grid = None
+        self.probe_colors = None
+
+    def _set_probes(self, image: MatLike) -> None:
+        (x_start, y_start), (x_end, y_end) = self.field
+        x_mid, y_mid = (x_start + x_end) // 2, (y_start + y_end) // 2
+        # Corners and edge midpoints just inside the field, plus the
+        # pixels right outside each edge, which move if the field does.
+        points = [(x_start, y_start), (x_end - 1, y_start),
+                  (x_start, y_end - 1), (x_end - 1, y_end - 1),
+                  (x_mid, y_start), (x_mid, y_end - 1),
+                  (x_start, y_mid), (x_end - 1, y_mid),
+                  (x_mid, y_start - 1), (x_mid, y_end),
+                  (x_start - 1, y_mid), (x_end, y_mid)]
+        height, width = image.shape[:2]
+        points = [(x, y) for x, y in points
+                  if 0 <= x < width and 0 <= y < height]
+        self.probe_xs = np.array([x for x, _ in points], dtype=np.intp)
+        self.probe_ys = np.array([y for _, y in points], dtype=np.intp)
+        self.probe_colors = image[self.probe_ys, self.probe_xs].copy()
+
+    def assign(self, image: MatLike, key: tuple,
+               field: tuple[Position, Position], grid: GridCoords) -> None:
+        self.key, self.field, self.grid = key, field, grid
+        self._set_probes(image)
+
+    def is_valid(self, image: MatLike, key: tuple) -> bool:
+        return self.grid is not None and self.key == key and \
+            np.array_equal(image[self.probe_ys, self.probe_xs],
+                           self.probe_colors)
+
+    def _restore(self, image: MatLike, key: tuple) -> bool:
+        stored_key = self._stored_key(key)
+        for index, entry in enumerate(self.entries):
+            if entry["key"] != stored_key:
+                continue
+            probes = np.array(entry["probes"], dtype=np.intp).reshape(-1, 5)
+            if not np.array_equal(image[probes[:, 1], probes[:, 0]],
+                                  probes[:, 2:]):
+                continue
+            (x_start, y_start), (x_end, y_end) = entry["field"]
+            self.key = key
+            self.field = (x_start, y_start), (x_end, y_end)
+            self.grid = entry["grid"][0], entry["grid"][1]
+            self.probe_xs, self.probe_ys = probes[:, 0], probes[:, 1]
+            self.probe_colors = probes[:, 2:].astype(image.dtype)
+            self.entries.insert(0, self.entries.pop(index))
+            return True
+        return False
+
+    def remember(self) -> None:
+        if self.grid is None or not self.path:
+            return
+        stored_key = self._stored_key(self.key)
+        (x_start, y_start), (x_end, y_end) = self.field
+        entry = {"key": stored_key,
+                 "field": [[x_start, y_start], [x_end, y_end]],
+                 "grid": [list(self.grid[0]), list(self.grid[1])],
+                 "probes": np.column_stack(
+                     [self.probe_xs, self.probe_ys,
+                      self.probe_colors.astype(np.intp)]).tolist()}
+        self.entries = [entry] + [
+            other for other in self.entries
+            if other["key"] != stored_key or other["field"] != entry["field"]
+        ][:GEOMETRY_ENTRIES - 1]
+        # Written aside and moved in place, as bot.py and hint.py may
+        # share the file.
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            json.dump({"version": 1, "entries": self.entries}, file)
+        os.replace(temporary, self.path)
+
+    def lookup(self, image: MatLike,
+               main_color: Color,
+               tile_padding: int,
+               field_padding: int) \
+            -> tuple[tuple[Position, Position] | None, GridCoords | None]:
+        key = (image.shape, main_color, tile_padding, field_padding)
+        if self.is_valid(image, key):
+            self.hits += 1
+            return self.field, self.grid
+
+        self.invalidate()
+        if self._restore(image, key):
+            self.restored += 1
+            return self.field, self.grid
+
+        self.misses += 1
+        field = find_minefield_bounds(image, main_color)
+        if field is None:
+            return None, None
+        grid = extract_grid_coordinates(
+            image, field, main_color, tile_padding, field_padding)
+        if grid is None:
+            return field, None
+
+        self.assign(image, key, field, grid)
+        if self.autosave:
+            self.remember()
+        return field, grid
+
+
+class MultiGeometryCache:
+    def __init__(self, min_side: int = MIN_FIELD_SIDE) -> None:
+        self.min_side = min_side
+        self.key: tuple | None = None
+        # One cache per minefield, only kept for its probes; several
+        # boards are never persisted.
+        self.boards: list[GeometryCache] = []
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self) -> None:
+        self.key = None
+        self.boards = []
+
+    def geometries(self) \
+            -> list[tuple[tuple[Position, Position], GridCoords]]:
+        return [(board.field, board.grid) for board in self.boards]
+
+    def lookup(self, image: MatLike,
+               main_color: Color,
+               tile_padding: int,
+               field_padding: int) \
+            -> list[tuple[tuple[Position, Position], GridCoords]]:
+        key = (image.shape, main_color, tile_padding, field_padding)
+        if self.boards and self.key == key and \
+                all(board.is_valid(image, key) for board in self.boards):
+            self.hits += 1
+            return self.geometries()
+
+        self.invalidate()
+        self.misses += 1
+        for field in find_minefields(image, main_color, self.min_side):
+            grid = extract_grid_coordinates(
+                image, field, main_color, tile_padding, field_padding)
+            # Panels of the main color that hold no grid aren't boards.
+            if grid is None or len(grid[0]) < 2 or len(grid[1]) < 2:
+                continue
+            board = GeometryCache(autosave=False)
+            board.assign(image, key, field, grid)
+            self.boards.append(board)
+        if self.boards:
+            self.key = key
+        return self.geometries()
+
+
 def classify_tile(tile: MatLike) -> str:
     unique_colors = np.unique(tile.reshape(-1, tile.shape[2]), axis=0)
     is_red = is_five = is_black = False
@@ -140,8 +396,129 @@ def classify_tile(tile: MatLike) -> str:
     return "0"
 
 
-def parse_game_state(image: MatLike,
-                     field_grid: GridCoords) -> list[str]:
+def _color_mask(image: MatLike, color_range: tuple[Color, Color]) \
+        -> MatLike:
+    lower, upper = color_range
+    return cv.inRange(image, np.array(lower, dtype=np.uint8),
+                      np.array(upper, dtype=np.uint8))
+
+
+def _tile_counts(mask: MatLike, rows: int, cols: int,
+                 tile_size: int) -> np.ndarray:
+    return np.count_nonzero(
+        mask.reshape(rows, tile_size, cols, tile_size), axis=(1, 3))
+
+
+def _first_digit(tile: MatLike) -> str:
+    # classify_tile returns the digit of the first matching color in
+    # np.unique order, which is lexicographic on (B, G, R).
+    pixels = tile.reshape(-1, 3).astype(np.int32)
+    keys = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+    best_key, best_symbol = None, "0"
+    for symbol, lower, upper in DIGIT_RANGES:
+        hits = np.all((pixels >= lower) & (pixels <= upper), axis=1)
+        if hits.any():
+            key = keys[hits].min()
+            if best_key is None or key < best_key:
+                best_key, best_symbol = key, symbol
+    return best_symbol
+
+
+def classify_tile_grid(image: MatLike, rows: int, cols: int,
+                       tile_size: int) -> np.ndarray:
+    board = np.zeros((rows, cols), dtype=np.uint8)
+    if rows == 0 or cols == 0:
+        return board
+
+    digits = np.stack([_tile_counts(_color_mask(image, (lower, upper)),
+                                    rows, cols, tile_size) > 0
+                       for _, lower, upper in DIGIT_RANGES])
+    five_mask = _color_mask(image, FIVE_RANGE)
+    is_red = _tile_counts(_color_mask(image, RED_RANGE),
+                          rows, cols, tile_size) > 0
+    is_five = _tile_counts(five_mask, rows, cols, tile_size) > 0
+    is_black = _tile_counts(
+        cv.bitwise_and(_color_mask(image, BLACK_RANGE),
+                       cv.bitwise_not(five_mask)),
+        rows, cols, tile_size) > 0
+
+    total_pixels = tile_size * tile_size
+    is_covered = _tile_counts(_color_mask(image, WHITE_RANGE), rows, cols,
+                              tile_size) / total_pixels > 0.1
+    is_gray = _tile_counts(_color_mask(image, GRAY_RANGE), rows, cols,
+                           tile_size) / total_pixels > 0.5
+
+    # Later assignments take precedence, mirroring classify_tile's order.
+    board[is_gray] = TILE_CODES["8"]
+    board[is_covered] = UNKNOWN_TILE
+    board[is_five] = TILE_CODES["5"]
+    board[is_red] = TILE_CODES["3"]
+    board[is_black] = TILE_CODES["7"]
+    board[is_black & is_red] = FLAG_TILE
+
+    digit_count = digits.sum(axis=0)
+    for (symbol, _, _), present in zip(DIGIT_RANGES, digits):
+        board[present & (digit_count == 1)] = TILE_CODES[symbol]
+    for y, x in zip(*np.nonzero(digit_count > 1)):
+        tile = image[y * tile_size:(y + 1) * tile_size,
+                     x * tile_size:(x + 1) * tile_size]
+        board[y, x] = TILE_CODES[_first_digit(tile)]
+    return board
+
+
+def board_to_strings(board: np.ndarray) -> list[str]:
+    return [row.tobytes().translate(SYMBOL_TABLE).decode()
+            for row in board]
+
+
+def board_from_strings(minefield: list[str]) -> np.ndarray:
+    if not minefield:
+        return np.zeros((0, 0), dtype=np.uint8)
+    raw = np.frombuffer("".join(minefield).encode(), dtype=np.uint8)
+    return CODE_TABLE[raw].reshape(len(minefield), -1)
+
+
+def _padded_field(image: MatLike, y_start: int, y_end: int,
+                  x_start: int, x_end: int) -> MatLike:
+    height, width = image.shape[:2]
+    top, left = max(-y_start, 0), max(-x_start, 0)
+    bottom, right = max(y_end - height, 0), max(x_end - width, 0)
+    region = image[max(y_start, 0):min(y_end, height),
+                   max(x_start, 0):min(x_end, width)]
+    return cv.copyMakeBorder(region, top, bottom, left, right,
+                             cv.BORDER_REPLICATE)
+
+
+def parse_game_board(image: MatLike,
+                     field_grid: GridCoords,
+                     classify: Classifier = classify_tile_grid) \
+        -> tuple[np.ndarray, list[str]]:
+    x_cords, y_cords = field_grid
+    tile_size = y_cords[1] - y_cords[0]
+    rows, cols = len(y_cords) - 1, len(x_cords) - 1
+    y_start, x_start = y_cords[0], x_cords[0]
+    y_end, x_end = y_start + rows * tile_size, x_start + cols * tile_size
+
+    if y_start < 0 or x_start < 0 or \
+            y_end > image.shape[0] or x_end > image.shape[1]:
+        if classify is classify_tile_grid:
+            # Tiles cut off by the image border can't be reshaped in one
+            # go.
+            board = board_from_strings(
+                parse_game_state_tiles(image, field_grid))
+        else:
+            # Other classifiers see cut off tiles completed from the edge.
+            board = classify(_padded_field(image, y_start, y_end,
+                                           x_start, x_end),
+                             rows, cols, tile_size)
+    else:
+        board = classify(image[y_start:y_end, x_start:x_end],
+                         rows, cols, tile_size)
+    return board, board_to_strings(board)
+
+
+def parse_game_state_tiles(image: MatLike,
+                           field_grid: GridCoords) -> list[str]:
     game_state = []
     x_cords, y_cords = field_grid
     tile_size = y_cords[1] - y_cords[0]
@@ -155,6 +532,73 @@ def parse_game_state(image: MatLike,
     return game_state
 
 
+def parse_game_state(image: MatLike,
+                     field_grid: GridCoords) -> list[str]:
+    return parse_game_board(image, field_grid)[1]
+
+
+class FrameParser:
+    def __init__(self, classify: Classifier = classify_tile_grid) -> None:
+        self.classify = classify
+        self.field_grid: GridCoords | None = None
+        self.tiles: np.ndarray | None = None
+        self.difference: np.ndarray | None = None
+        self.board: np.ndarray | None = None
+        self.game_state: list[str] = []
+
+    def reset(self) -> None:
+        self.field_grid = None
+        self.tiles = None
+        self.difference = None
+        self.board = None
+        self.game_state = []
+
+    def parse(self, image: MatLike, field_grid: GridCoords) \
+            -> tuple[np.ndarray, list[str], set[Position]]:
+        x_cords, y_cords = field_grid
+        tile_size = y_cords[1] - y_cords[0]
+        rows, cols = len(y_cords) - 1, len(x_cords) - 1
+        y_start, x_start = y_cords[0], x_cords[0]
+        y_end, x_end = y_start + rows * tile_size, x_start + cols * tile_size
+
+        if y_start < 0 or x_start < 0 or \
+                y_end > image.shape[0] or x_end > image.shape[1]:
+            self.reset()
+            board, game_state = parse_game_board(image, field_grid,
+                                                 self.classify)
+            return board, game_state, set(np.ndindex(board.shape))
+
+        region = image[y_start:y_end, x_start:x_end]
+        if self.field_grid != field_grid or self.tiles is None:
+            self.field_grid = field_grid
+            self.tiles = region.copy()
+            self.difference = np.empty_like(region)
+            self.board = self.classify(region, rows, cols, tile_size)
+            self.game_state = board_to_strings(self.board)
+            return self.board, self.game_state, \
+                set(np.ndindex(self.board.shape))
+
+        difference = cv.absdiff(region, self.tiles, dst=self.difference)
+        changed = np.any(
+            difference.reshape(rows, tile_size, cols, tile_size * 3),
+            axis=(1, 3))
+        ys, xs = np.nonzero(changed)
+        if len(ys) == 0:
+            return self.board, self.game_state, set()
+
+        tiles = region.reshape(rows, tile_size, cols, tile_size, 3)[
+            ys, :, xs]
+        self.board[ys, xs] = self.classify(
+            tiles.reshape(-1, tile_size, 3), len(ys), 1, tile_size)[:, 0]
+        np.copyto(self.tiles, region)
+
+        for y in np.unique(ys):
+            self.game_state[y] = \
+                self.board[y].tobytes().translate(SYMBOL_TABLE).decode()
+        return self.board, self.game_state, \
+            set(zip(ys.tolist(), xs.tolist()))
+
+
 def get_neighbors(tile_index: Position,
                   minefield: list[str]) -> list[Position]:
     y, x = tile_index
@@ -0,0 +1,296 @@
+import time
+from typing import Iterator, NamedTuple
+import numpy as np
+from common import VICINITY, \
+    UNKNOWN_TILE, \
+    FLAG_TILE, \
+    neighbor_counts
+from propagation import SAFE, \
+    DANGEROUS
+
+Position = tuple[int, int]
+Constraint = tuple[list[int], int]
+
+NODE_LIMIT = 20000
+# Search nodes between two looks at the clock.
+DEADLINE_CHECK = 1024
+
+SOLVED = 0
+UNSATISFIABLE = 1
+OUT_OF_BUDGET = 2
+
+
+class Component(NamedTuple):
+    cells: list[Position]
+    constraints: list[Constraint]
+
+
+def frontier_components(board: np.ndarray,
+                        labels: np.ndarray | None = None) \
+        -> list[Component]:
+    rows, cols = board.shape
+    if labels is None:
+        labels = np.zeros_like(board)
+    open_cells = (board == UNKNOWN_TILE) & (labels != SAFE) & \
+        (labels != DANGEROUS)
+    is_number = (board >= 1) & (board <= 8)
+    numbers = np.argwhere(is_number & (neighbor_counts(open_cells) > 0))
+
+    # Known mines count against the number, known safe tiles drop out.
+    mines = (board == FLAG_TILE) | \
+        ((board == UNKNOWN_TILE) & (labels == DANGEROUS))
+    known_mines = neighbor_counts(mines)
+
+    cell_ids: dict[Position, int] = {}
+    cells: list[Position] = []
+    raw_constraints: list[Constraint] = []
+    for y, x in numbers.tolist():
+        members = []
+        for j, i in VICINITY:
+            ny, nx = y + i, x + j
+            if 0 <= ny < rows and 0 <= nx < cols and open_cells[ny, nx]:
+                if (ny, nx) not in cell_ids:
+                    cell_ids[(ny, nx)] = len(cells)
+                    cells.append((ny, nx))
+                members.append(cell_ids[(ny, nx)])
+        raw_constraints.append(
+            (members, int(board[y, x]) - int(known_mines[y, x])))
+
+    parent = list(range(len(cells)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for members, _ in raw_constraints:
+        root = find(members[0])
+        for member in members[1:]:
+            other = find(member)
+            if other != root:
+                parent[other] = root
+
+    groups: dict[int, Component] = {}
+    local_ids: dict[int, int] = {}
+    for cell_id, cell in enumerate(cells):
+        component = groups.setdefault(find(cell_id), Component([], []))
+        local_ids[cell_id] = len(component.cells)
+        component.cells.append(cell)
+    for members, need in raw_constraints:
+        component = groups[find(members[0])]
+        component.constraints.append(
+            ([local_ids[member] for member in members], need))
+    return list(groups.values())
+
+
+class ComponentSolver:
+    def __init__(self, component: Component) -> None:
+        self.size = len(component.cells)
+        self.members = [members for members, _ in component.constraints]
+        self.needs = [need for _, need in component.constraints]
+        self.cell_constraints: list[list[int]] = [[] for _ in
+                                                  range(self.size)]
+        for index, members in enumerate(self.members):
+            for member in members:
+                self.cell_constraints[member].append(index)
+        self.order = self._search_order()
+        self.nodes = 0
+        self.out_of_budget = False
+
+    def _search_order(self) -> list[int]:
+        # Breadth-first over shared constraints keeps related cells close
+        # in the order, so contradictions surface after few assignments.
+        order: list[int] = []
+        seen = bytearray(self.size)
+        for start in range(self.size):
+            if seen[start]:
+                continue
+            seen[start] = 1
+            queue = [start]
+            for cell in queue:
+                order.append(cell)
+                for index in self.cell_constraints[cell]:
+                    for member in self.members[index]:
+                        if not seen[member]:
+                            seen[member] = 1
+                            queue.append(member)
+        return order
+
+    def solutions(self, fixed: dict[int, int], node_limit: int,
+                  deadline: float | None = None) -> Iterator[list[int]]:
+        self.out_of_budget = False
+        assignment = [-1] * self.size
+        mines = [0] * len(self.members)
+        free = [len(members) for members in self.members]
+        trail: list[int] = []
+
+        def assign(cell: int, value: int) -> bool:
+            pending = [(cell, value)]
+            while pending:
+                cell, value = pending.pop()
+                if assignment[cell] != -1:
+                    if assignment[cell] != value:
+                        return False
+                    continue
+                assignment[cell] = value
+                trail.append(cell)
+                constraints = self.cell_constraints[cell]
+                for index in constraints:
+                    free[index] -= 1
+                    mines[index] += value
+                for index in constraints:
+                    need = self.needs[index]
+                    if mines[index] > need or \
+                            mines[index] + free[index] < need:
+                        return False
+                    if free[index] == 0:
+                        continue
+                    if mines[index] == need:
+                        pending.extend((member, 0) for member in
+                                       self.members[index]
+                                       if assignment[member] == -1)
+                    elif mines[index] + free[index] == need:
+                        pending.extend((member, 1) for member in
+                                       self.members[index]
+                                       if assignment[member] == -1)
+            return True
+
+        def undo(mark: int) -> None:
+            while len(trail) > mark:
+                cell = trail.pop()
+                value = assignment[cell]
+                assignment[cell] = -1
+                for index in self.cell_constraints[cell]:
+                    free[index] += 1
+                    mines[index] -= value
+
+        def next_free(position: int) -> int:
+            while position < self.size and \
+                    assignment[self.order[position]] != -1:
+                position += 1
+            return position
+
+        for cell, value in fixed.items():
+            if not assign(cell, value):
+                return
+
+        stack: list[tuple[int, int, int | None]] = []
+        position = next_free(0)
+        while True:
+            if position == self.size:
+                yield assignment
+            else:
+                self.nodes += 1
+                node_limit -= 1
+                if node_limit < 0 or deadline is not None and \
+                        not self.nodes % DEADLINE_CHECK and \
+                        time.perf_counter() >= deadline:
+                    self.out_of_budget = True
+                    return
+                mark = len(trail)
+                stack.append((position, mark, 1))
+                if assign(self.order[position], 0):
+                    position = next_free(position + 1)
+                    continue
+            while True:
+                if not stack:
+                    return
+                position, mark, alternative = stack.pop()
+                undo(mark)
+                if alternative is None:
+                    continue
+                stack.append((position, mark, None))
+                if assign(self.order[position], alternative):
+                    position = next_free(position + 1)
+                    break
+
+    def search(self, fixed: dict[int, int], node_limit: int,
+               deadline: float | None = None) \
+            -> tuple[int, list[int] | None]:
+        solution = next(self.solutions(fixed, node_limit, deadline), None)
+        if solution is not None:
+            return SOLVED, list(solution)
+        return (OUT_OF_BUDGET if self.out_of_budget else UNSATISFIABLE), \
+            None
+
+    def tally(self, node_limit: int = NODE_LIMIT) \
+            -> tuple[list[int], list[list[int]]] | None:
+        counts = [0] * (self.size + 1)
+        cell_counts = [[0] * self.size for _ in range(self.size + 1)]
+        for solution in self.solutions({}, node_limit):
+            num_mines = sum(solution)
+            counts[num_mines] += 1
+            row = cell_counts[num_mines]
+            for cell, value in enumerate(solution):
+                row[cell] += value
+        if self.out_of_budget:
+            return None
+        return counts, cell_counts
+
+    def solve(self, node_limit: int = NODE_LIMIT,
+              deadline: float | None = None) \
+            -> tuple[list[int], list[int]]:
+        status, solution = self.search({}, node_limit, deadline)
+        if status != SOLVED:
+            return [], []
+        seen_mine = bytearray(self.size)
+        seen_safe = bytearray(self.size)
+
+        def witness(solution: list[int]) -> None:
+            for cell, value in enumerate(solution):
+                if value:
+                    seen_mine[cell] = 1
+                else:
+                    seen_safe[cell] = 1
+
+        # A cell is forced once the opposite value has no solution; any
+        # solution found on the way rules out every cell it disagrees on.
+        witness(solution)
+        fixed: dict[int, int] = {}
+        for cell in self.order:
+            if seen_mine[cell] and seen_safe[cell]:
+                continue
+            known = 1 if seen_mine[cell] else 0
+            status, solution = self.search({**fixed, cell: 1 - known},
+                                           node_limit, deadline)
+            if status == SOLVED:
+                witness(solution)
+            elif status == UNSATISFIABLE:
+                fixed[cell] = known
+
+        safe = [cell for cell, value in fixed.items() if value == 0]
+        mines = [cell for cell, value in fixed.items() if value == 1]
+        return safe, mines
+
+
+def solve_frontier(board: np.ndarray,
+                   labels: np.ndarray | None = None,
+                   node_limit: int = NODE_LIMIT,
+                   deadline: float | None = None) \
+        -> tuple[set[Position], set[Position]]:
+    safe: set[Position] = set()
+    mines: set[Position] = set()
+    for component in frontier_components(board, labels):
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if any(need < 0 or need > len(members)
+               for members, need in component.constraints):
+            continue
+        component_safe, component_mines = \
+            ComponentSolver(component).solve(node_limit, deadline)
+        safe.update(component.cells[cell] for cell in component_safe)
+        mines.update(component.cells[cell] for cell in component_mines)
+    return safe, mines
+
+
+def apply_frontier(board: np.ndarray,
+                   labels: np.ndarray,
+                   node_limit: int = NODE_LIMIT,
+                   deadline: float | None = None) -> np.ndarray:
+    safe, mines = solve_frontier(board, labels, node_limit, deadline)
+    for y, x in safe:
+        labels[y, x] = SAFE
+    for y, x in mines:
+        labels[y, x] = DANGEROUS
+    return labels
@@ -4,17 +4,26 @@ import time
 import cv2 as cv
 from cv2.typing import MatLike
 import numpy as np
-import pyautogui
-from common import find_minefield_bounds, \
-    extract_grid_coordinates, \
-    parse_game_state, \
-    get_neighbors
-
-from itertools import product
+from backend import load_backend, \
+    load_capture
+from common import GeometryCache, \
+    GEOMETRY_CACHE, \
+    FrameParser, \
+    board_from_strings
+from propagation import labels_to_strings, \
+    labels_from_strings
+from probability import mine_probabilities
+from recording import load_recorder
+from solver import Solver, \
+    UNLIMITED, \
+    load_solver
+from palette import load_classifier
+from metrics import load_metrics
+from polling import board_signature, \
+    load_poller
 
 Position = tuple[int, int]
 Color = tuple[int, int, int]
-HintChange = tuple[Position, str]
 GridCoords = tuple[list[int], list[int]]
 
 NO_LABEL = "0"
@@ -26,165 +35,84 @@ LABEL_COLORS = {WRONG_FLAG: (0, 255, 255),
                 SAFE: (0, 255, 0),
                 DANGEROUS: (0, 0, 255),
                 WRONG_FLAG_NEAR: (255, 0, 255)}
+# Overlay color codes: labels first, then quantized mine probabilities.
+PROBABILITY_BASE = 8
+PROBABILITY_LEVELS = 256
+
+
+def generate_hint_map(minefield: list[str],
+                      solver: Solver = UNLIMITED) -> list[str]:
+    board = board_from_strings(minefield)
+    return labels_to_strings(solver.solve(board).labels)
+
+
+def probability_color(probability: float) -> Color:
+    return 0, int(255 * (1 - probability)), int(255 * probability)
+
+
+def _color_table() -> np.ndarray:
+    table = np.zeros((PROBABILITY_BASE + PROBABILITY_LEVELS, 3),
+                     dtype=np.uint8)
+    for label, color in LABEL_COLORS.items():
+        table[int(label)] = color
+    for level in range(PROBABILITY_LEVELS):
+        table[PROBABILITY_BASE + level] = \
+            probability_color(level / (PROBABILITY_LEVELS - 1))
+    return table
+
+
+COLOR_TABLE = _color_table()
+
 
+def overlay_codes(hint: list[str],
+                  probabilities: np.ndarray | None = None) -> np.ndarray:
+    codes = labels_from_strings(hint).astype(np.uint16)
+    if probabilities is not None:
+        shaded = (codes == int(NO_LABEL)) & ~np.isnan(probabilities)
+        codes[shaded] = PROBABILITY_BASE + np.round(
+            probabilities[shaded] * (PROBABILITY_LEVELS - 1)).astype(np.uint16)
+    return codes
 
-def analyze_tile_neighbors(tile_index: Position,
-                           minefield: list[str],
-                           hint: list[str]) -> list[HintChange]:
-    y, x = tile_index
-    neighbours = get_neighbors(tile_index, minefield)
-    changes: list[HintChange] = []
-    num_mines = int(minefield[y][x])
-
-    num_flags = sum(1 for i, j in neighbours if minefield[i][j] == "F")
-    num_unknowns = sum(1 for i, j in neighbours if minefield[i][j] == "?")
-    num_dangerous = sum(1 for i, j in neighbours if hint[i][j] in
-                        {DANGEROUS, WRONG_FLAG_NEAR})
-    num_safe = sum(1 for i, j in neighbours if hint[i][j] == SAFE)
-    num_correct_flags = 0
-
-    if num_flags > num_mines:
-        changes.extend(((i, j), WRONG_FLAG) for i, j in neighbours if
-                       minefield[i][j] == "F" and hint[i][j] == NO_LABEL)
-    else:
-        num_correct_flags = sum(1 for i, j in neighbours if
-                                hint[i][j] == NO_LABEL and
-                                minefield[i][j] == "F")
-
-    if num_correct_flags == num_mines:
-        changes.extend(((i, j), SAFE) for i, j in neighbours if
-                       minefield[i][j] == "?" and hint[i][j] != SAFE)
-    if num_correct_flags + num_dangerous == num_mines:
-        changes.extend(((i, j), SAFE) for i, j in neighbours if
-                       minefield[i][j] == "?" and hint[i][j] == NO_LABEL)
-
-    if num_unknowns - num_safe + num_flags == num_mines:
-        changes.extend(((i, j), DANGEROUS) for i, j in neighbours if
-                       minefield[i][j] == "?" and hint[i][j] == NO_LABEL)
-        changes.extend(((i, j), WRONG_FLAG_NEAR) for i, j in neighbours if
-                       minefield[i][j] == "F" and hint[i][j] == WRONG_FLAG)
-    return changes
-
-
-def validate_mine_flags(tile_index: Position,
-                        minefield: list[str],
-                        hint: list[str]) -> list[HintChange]:
-    y, x = tile_index
-    changes: list[HintChange] = []
-    neighbours = get_neighbors(tile_index, minefield)
-
-    num_mines = int(minefield[y][x])
-    num_flags = sum(1 for i, j in neighbours if minefield[i][j] == "F")
-
-    if num_flags > num_mines:
-        changes.extend(((i, j), WRONG_FLAG) for i, j in neighbours if
-                       minefield[i][j] == "F" and hint[i][j] == NO_LABEL)
-    return changes
-
-def analyze_double_tile_patterns(minefield: list[str], hint: list[str]) -> list[HintChange]:
-    height = len(minefield)
-    width = len(minefield[0]) if height > 0 else 0
-    changes: list[HintChange] = []
-    directions = [(0, 1), (1, 0)]  # right and down only to avoid redundancy
-
-    def is_number(s: str) -> bool:
-        return s.isdigit() and s != "0"
-
-    for y in range(height):
-        for x in range(width):
-            if not is_number(minefield[y][x]):
-                continue
-            for dy, dx in directions:
-                ny, nx = y + dy, x + dx
-                if not (0 <= ny < height and 0 <= nx < width):
-                    continue
-                if not is_number(minefield[ny][nx]):
-                    continue
-
-                # Fetch tile values
-                val1 = int(minefield[y][x])
-                val2 = int(minefield[ny][nx])
-
-                # Get neighbors
-                n1 = set(get_neighbors((y, x), minefield))
-                n2 = set(get_neighbors((ny, nx), minefield))
-                shared = n1 & n2
-                only1 = n1 - n2
-                only2 = n2 - n1
-
-                # Get counts
-                f1 = sum(1 for i, j in n1 if minefield[i][j] == "F")
-                f2 = sum(1 for i, j in n2 if minefield[i][j] == "F")
-                u1 = [pos for pos in only1 if minefield[pos[0]][pos[1]] == "?"]
-                u2 = [pos for pos in only2 if minefield[pos[0]][pos[1]] == "?"]
-                shared_unknown = [pos for pos in shared if minefield[pos[0]][pos[1]] == "?"]
-
-                rem1 = val1 - f1
-                rem2 = val2 - f2
-
-                # Example inference rule: If rem2 - rem1 == len(u2), then all u2 are mines
-                if rem2 > rem1 and rem2 - rem1 == len(u2):
-                    for pos in u2:
-                        if hint[pos[0]][pos[1]] == NO_LABEL:
-                            changes.append((pos, DANGEROUS))
-                # Or vice versa: if rem1 - rem2 == len(u1), u1 are mines
-                if rem1 > rem2 and rem1 - rem2 == len(u1):
-                    for pos in u1:
-                        if hint[pos[0]][pos[1]] == NO_LABEL:
-                            changes.append((pos, DANGEROUS))
-                # Safe inference: if rem1 == rem2 and shared_unknown and u1/u2 exist, maybe they're safe
-                if rem1 == rem2 and shared_unknown and not u1 and not u2:
-                    for pos in shared_unknown:
-                        if hint[pos[0]][pos[1]] == NO_LABEL:
-                            changes.append((pos, SAFE))
-    return changes
-
-
-def generate_hint_map(minefield: list[str]) -> list[str]:
-    hint = [len(row) * NO_LABEL for row in minefield]
-    non_important = {"?", "0", "F"}
-
-    for y, row in enumerate(minefield):
-        for x, tile in enumerate(row):
-            if tile in non_important:
-                continue
-
-            changes = validate_mine_flags((y, x), minefield, hint)
-            for (i, j), new_label in changes:
-                hint[i] = hint[i][:j] + new_label + hint[i][j + 1:]
-
-    change_count = 1
-    while change_count > 0:
-        change_count = 0
-        for y, row in enumerate(minefield):
-            for x, tile in enumerate(row):
-                if tile not in non_important:
-                    changes = analyze_tile_neighbors((y, x), minefield, hint)
-                    for (i, j), new_label in changes:
-                        hint[i] = hint[i][:j] + new_label + hint[i][j + 1:]
-                        change_count += 1
-    # Add pattern inference after normal rules
-    changes = analyze_double_tile_patterns(minefield, hint)
-    for (i, j), new_label in changes:
-        hint[i] = hint[i][:j] + new_label + hint[i][j + 1:]
-
-    return hint
-
-
-def generate_overlay(image: MatLike, hint: list[str],
-                     field_grid: GridCoords) -> MatLike:
-    x_coords, y_coords = field_grid
-    tile_size = field_grid[0][1] - field_grid[0][0]
-    overlay = np.zeros_like(image, dtype=np.uint8)
-
-    for y_idx, y in enumerate(y_coords[:-1]):
-        for x_idx, x in enumerate(x_coords[:-1]):
-            label = hint[y_idx][x_idx]
-            if label != NO_LABEL:
-                cv.rectangle(overlay, (x, y), (x + tile_size, y + tile_size),
-                             LABEL_COLORS[label], thickness=-1)
-    image = cv.addWeighted(image, 1, overlay, 0.5, 0)
-    return image
+
+class OverlayRenderer:
+    def __init__(self) -> None:
+        self.key: tuple | None = None
+        self.codes: np.ndarray | None = None
+        self.layer: np.ndarray | None = None
+        self.output: np.ndarray | None = None
+
+    def render(self, image: MatLike, hint: list[str],
+               field_grid: GridCoords,
+               field: tuple[Position, Position],
+               probabilities: np.ndarray | None = None) -> MatLike:
+        # Only the minefield crop is ever shown, so that's all that gets
+        # colored and blended.
+        (x_start, y_start), (x_end, y_end) = field
+        crop = image[y_start:y_end, x_start:x_end]
+        x_coords, y_coords = field_grid
+        tile_size = x_coords[1] - x_coords[0]
+        top, left = y_coords[0] - y_start, x_coords[0] - x_start
+        rows = min(len(y_coords) - 1, (crop.shape[0] - top) // tile_size)
+        cols = min(len(x_coords) - 1, (crop.shape[1] - left) // tile_size)
+
+        key = (crop.shape, top, left, rows, cols, tile_size)
+        if key != self.key:
+            self.key = key
+            self.codes = np.zeros((rows, cols), dtype=np.uint16)
+            self.layer = np.zeros_like(crop)
+            self.output = np.empty_like(crop)
+
+        codes = overlay_codes(hint, probabilities)[:rows, :cols]
+        ys, xs = np.nonzero(codes != self.codes)
+        if len(ys):
+            tiles = self.layer[top:top + rows * tile_size,
+                               left:left + cols * tile_size]
+            tiles = tiles.reshape(rows, tile_size, cols, tile_size, 3)
+            tiles[ys, :, xs] = COLOR_TABLE[codes[ys, xs]][:, None, None]
+            self.codes[ys, xs] = codes[ys, xs]
+
+        cv.addWeighted(crop, 1, self.layer, 0.5, 0, dst=self.output)
+        return self.output
 
 
 def main() -> None:
@@ -196,34 +124,84 @@ def main() -> None:
     check_delay = int(os.getenv("CHECK_DELAY", 2))
     tile_padding = int(os.getenv("TILE_PADDING", 5))
     field_padding = int(os.getenv("FIELD_PADDING", 12))
-
+    show_probabilities = int(os.getenv("SHOW_PROBABILITIES", 0)) != 0
+    total_mines = int(os.getenv("TOTAL_MINES", 0)) or None
+
+    backend = load_backend()
+    if backend.tile_padding is not None:
+        tile_padding = backend.tile_padding
+        field_padding = backend.field_padding
+
+    capture = load_capture(backend, right_half=True)
+
+    geometry = GeometryCache(os.getenv("GEOMETRY_CACHE", GEOMETRY_CACHE)
+                             or None)
+    parser = FrameParser(load_classifier())
+    overlay = OverlayRenderer()
+    recorder = load_recorder("hint")
+    solver = load_solver()
+    metrics = load_metrics("hint")
+    poller = load_poller(check_delay)
     while True:
-        screenshot = np.array(pyautogui.screenshot())
-        right_side = screenshot[:, len(screenshot[0]) // 2:]
-        right_side = cv.cvtColor(right_side, cv.COLOR_RGB2BGR)
-
-        field = find_minefield_bounds(right_side, main_color)
+        metrics.frame()
+        with metrics.stage("capture"):
+            right_side, offset = capture.grab()
+
+        with metrics.stage("geometry"):
+            field, grid = geometry.lookup(
+                right_side, main_color, tile_padding, field_padding)
+        if field is None or grid is None:
+            poller.invalidate()
+        if (field is None or grid is None) and capture.reset():
+            continue
         if field is None:
             print("Coudn't find the minefield. Trying again in 1 second.")
             time.sleep(check_delay)
             continue
-        grid = extract_grid_coordinates(
-            right_side, field, main_color, tile_padding, field_padding)
         if grid is None:
             print("Coudn't extract the grid coordinates. Trying again in 1 second.")
             time.sleep(check_delay)
             continue
-        game_state = parse_game_state(right_side, grid)
-        hint = generate_hint_map(game_state)
-        (x_start, y_start), (x_end, y_end) = field
-        output = generate_overlay(right_side, hint, grid)[y_start: y_end,
-                                                          x_start: x_end]
-        cv.imshow("Hint", output)
-
-        key = cv.waitKey(check_delay)
+        capture.focus(field, offset)
+        # An unchanged board keeps the overlay already on screen and polls
+        # less and less often until something moves.
+        with metrics.stage("check"):
+            changed = poller.changed(board_signature(right_side, grid))
+        if not changed:
+            if cv.waitKey(poller.delay) == ord("q"):
+                break
+            continue
+        with metrics.stage("parse"):
+            board, game_state, _ = parser.parse(right_side, grid)
+        with metrics.stage("solve"):
+            hint = generate_hint_map(game_state, solver)
+        if recorder is not None:
+            with metrics.stage("record"):
+                recorder.write(board, labels_from_strings(hint), grid,
+                               right_side)
+        probabilities = None
+        if show_probabilities:
+            with metrics.stage("probabilities"):
+                probabilities = mine_probabilities(
+                    board, labels_from_strings(hint), total_mines)
+        with metrics.stage("overlay"):
+            image = overlay.render(right_side, hint, grid, field,
+                                   probabilities)
+        cv.imshow("Hint", image)
+
+        key = cv.waitKey(poller.delay)
         if key == ord("q"):
             break
     cv.destroyAllWindows()
+    metrics.close()
+    poller.report()
+    solver.report()
+    solver.close()
+    if recorder is not None:
+        recorder.close()
+        print(f"Recorded {recorder.frames} frames.")
+    print(f"Geometry cache: {geometry.hits} hits, {geometry.misses} misses, "
+          f"{geometry.restored} restored from disk.")
 
 
 if __name__ == "__main__":
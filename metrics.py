@@ -0,0 +1,213 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Percentiles are taken over the most recent samples of each stage.
+WINDOW = 1024
+PERCENTILES = (50, 95, 99)
+SNAPSHOT_INTERVAL = 10.0
+
+
+class Histogram:
+    def __init__(self, window: int = WINDOW) -> None:
+        self.samples = np.zeros(window, dtype=np.float64)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+        self.total += seconds
+
+    def percentiles(self) -> list[float]:
+        recent = self.samples[:min(self.count, len(self.samples))]
+        return np.percentile(recent, PERCENTILES).tolist()
+
+
+class Profiler:
+    def __init__(self, frames: int, path: str) -> None:
+        self.profile = cProfile.Profile()
+        self.remaining = frames
+        self.path = path
+        self.running = False
+
+    def frame(self) -> None:
+        if self.remaining <= 0:
+            return
+        if not self.running:
+            # Only the calling thread is profiled: in pipelined mode that
+            # leaves out capturing and clicking.
+            self.profile.enable()
+            self.running = True
+            return
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.stop()
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self.profile.disable()
+        self.running = False
+        self.remaining = 0
+        self.profile.dump_stats(self.path)
+        print(f"Profile saved to {self.path}.")
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_) -> None:
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    def __init__(self, source: str = "",
+                 path: str | None = None,
+                 prometheus_path: str | None = None,
+                 interval: float = SNAPSHOT_INTERVAL,
+                 profiler: Profiler | None = None) -> None:
+        self.source = source
+        self.file = open(path, "a") if path else None
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.profiler = profiler
+        self.enabled = bool(path or prometheus_path or profiler)
+        self.histograms: dict[str, Histogram] = {}
+        # Capture and click threads record into the same histograms.
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.last_frame: float | None = None
+        self.last_snapshot = time.perf_counter()
+
+    def stage(self, name: str) -> _Timer | _NullTimer:
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def frame(self) -> None:
+        # Called once per loop iteration; the time between calls is the
+        # "frame" stage.
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.last_frame is not None:
+            self.record("frame", now - self.last_frame)
+        self.last_frame = now
+        self.frames += 1
+        if self.profiler is not None:
+            self.profiler.frame()
+        if now - self.last_snapshot >= self.interval:
+            self.last_snapshot = now
+            self.write()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stages = {}
+            for name, histogram in self.histograms.items():
+                p50, p95, p99 = histogram.percentiles()
+                stages[name] = {"count": histogram.count,
+                                "total_s": histogram.total,
+                                "p50_ms": p50 * 1000,
+                                "p95_ms": p95 * 1000,
+                                "p99_ms": p99 * 1000}
+        return {"timestamp": time.time(), "source": self.source,
+                "frames": self.frames, "stages": stages}
+
+    def write(self) -> None:
+        snapshot = self.snapshot()
+        if self.file is not None:
+            self.file.write(json.dumps(snapshot) + "\n")
+            self.file.flush()
+        if self.prometheus_path:
+            self._write_prometheus(snapshot)
+
+    def _write_prometheus(self, snapshot: dict) -> None:
+        lines = ["# HELP minesweeper_stage_seconds "
+                 "Time spent in each stage of the main loop.",
+                 "# TYPE minesweeper_stage_seconds summary"]
+        for name, stage in snapshot["stages"].items():
+            labels = f'source="{self.source}",stage="{name}"'
+            for percentile in PERCENTILES:
+                lines.append(
+                    f'minesweeper_stage_seconds{{{labels},'
+                    f'quantile="{percentile / 100}"}} '
+                    f'{stage[f"p{percentile}_ms"] / 1000:.6f}')
+            lines.append(f"minesweeper_stage_seconds_sum{{{labels}}} "
+                         f"{stage['total_s']:.6f}")
+            lines.append(f"minesweeper_stage_seconds_count{{{labels}}} "
+                         f"{stage['count']}")
+        # Written aside and moved in place, so a scraper never reads half.
+        temporary = self.prometheus_path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary, self.prometheus_path)
+
+    def report(self) -> None:
+        snapshot = self.snapshot()
+        if not snapshot["stages"]:
+            return
+        print(f"{'stage':>13} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'p99 ms':>9}")
+        for name, stage in snapshot["stages"].items():
+            print(f"{name:>13} {stage['count']:7d} {stage['p50_ms']:9.2f} "
+                  f"{stage['p95_ms']:9.2f} {stage['p99_ms']:9.2f}")
+
+    def close(self) -> None:
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.write()
+        self.report()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+NO_METRICS = Metrics()
+
+
+def load_metrics(source: str) -> Metrics:
+    frames = int(os.getenv("PROFILE_FRAMES", 0))
+    profiler = None
+    if frames > 0:
+        profiler = Profiler(frames, os.getenv("PROFILE_FILE", "")
+                            or f"{source}.prof")
+    return Metrics(source,
+                   os.getenv("METRICS_FILE", "") or None,
+                   os.getenv("METRICS_PROMETHEUS", "") or None,
+                   float(os.getenv("METRICS_INTERVAL", SNAPSHOT_INTERVAL)),
+                   profiler)
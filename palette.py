@@ -0,0 +1,158 @@
+import json
+import os
+import numpy as np
+from cv2.typing import MatLike
+from common import TILE_SYMBOLS, \
+    TILE_CODES, \
+    Classifier, \
+    classify_tile_grid
+
+Color = tuple[int, int, int]
+
+# Colors are looked up by their top 5 bits per channel, 32768 cells.
+QUANT_BITS = 5
+QUANT_SHIFT = 8 - QUANT_BITS
+# Colors covering less of every sample than this are edge blending and
+# don't get a palette entry of their own.
+MIN_COLOR_FRACTION = 0.01
+# Colors farther than this from every palette entry count as "other".
+MAX_COLOR_DISTANCE = 48
+# Colors kept per symbol in a saved profile.
+MAX_SYMBOL_COLORS = 64
+# Pixels per bincount call while building tile histograms.
+CHUNK_PIXELS = 1 << 22
+
+
+def color_fractions(tiles: list[MatLike]) -> list[tuple[Color, float]]:
+    pixels = np.concatenate([tile.reshape(-1, 3) for tile in tiles])
+    colors, counts = np.unique(pixels, axis=0, return_counts=True)
+    order = np.argsort(counts)[::-1][:MAX_SYMBOL_COLORS]
+    return [(tuple(colors[i].tolist()), counts[i] / len(pixels))
+            for i in order]
+
+
+def _color_lut(palette: np.ndarray) -> np.ndarray:
+    levels = 1 << QUANT_BITS
+    centers = (np.arange(levels) << QUANT_SHIFT) + (1 << QUANT_SHIFT) // 2
+    cells = np.stack(np.meshgrid(centers, centers, centers, indexing="ij"),
+                     axis=-1).reshape(-1, 1, 3)
+    lut = np.full(len(cells), len(palette), dtype=np.uint8)
+    if len(palette):
+        distances = ((cells - palette[None]) ** 2).sum(axis=2)
+        nearest = distances.argmin(axis=1)
+        close = distances[np.arange(len(cells)), nearest] <= \
+            MAX_COLOR_DISTANCE ** 2
+        lut[close] = nearest[close]
+    return lut
+
+
+def _color_indices(image: MatLike) -> np.ndarray:
+    quantized = image >> QUANT_SHIFT
+    indices = quantized[..., 0].astype(np.uint16) << 2 * QUANT_BITS
+    indices |= quantized[..., 1].astype(np.uint16) << QUANT_BITS
+    indices |= quantized[..., 2]
+    return indices
+
+
+class PaletteProfile:
+    def __init__(self, symbols: dict[str, list[tuple[Color, float]]]) \
+            -> None:
+        if not symbols:
+            raise ValueError("A palette profile needs at least one symbol")
+        self.symbols = symbols
+        colors = sorted({color for entries in symbols.values()
+                         for color, fraction in entries
+                         if fraction >= MIN_COLOR_FRACTION})
+        if len(colors) > 255:
+            raise ValueError(f"Too many palette colors: {len(colors)}")
+        self.palette = np.array(colors, dtype=np.int32).reshape(-1, 3)
+        self.lut = _color_lut(self.palette)
+        self.classes = len(colors) + 1
+
+        # Each symbol is described by how much of its tile every palette
+        # class covers; tiles get the symbol with the closest histogram.
+        self.codes = np.array([TILE_CODES[symbol] for symbol in symbols],
+                              dtype=np.uint8)
+        self.references = np.zeros((len(symbols), self.classes))
+        for row, entries in enumerate(symbols.values()):
+            for color, fraction in entries:
+                index = _color_indices(np.array([[color]], dtype=np.uint8))
+                self.references[row, self.lut[index[0, 0]]] += fraction
+            self.references[row, -1] += max(
+                0.0, 1 - self.references[row].sum())
+        self.reference_norms = (self.references ** 2).sum(axis=1)
+
+    @classmethod
+    def from_samples(cls, samples: dict[str, list[MatLike]],
+                     base: "PaletteProfile | None" = None) \
+            -> "PaletteProfile":
+        symbols = dict(base.symbols) if base is not None else {}
+        for symbol, tiles in samples.items():
+            if symbol not in TILE_CODES:
+                raise ValueError(f"Unknown tile symbol: {symbol!r}")
+            if tiles:
+                symbols[symbol] = color_fractions(tiles)
+        return cls(symbols)
+
+    @classmethod
+    def load(cls, path: str) -> "PaletteProfile":
+        with open(path) as file:
+            data = json.load(file)
+        return cls({symbol: [((b, g, r), fraction)
+                             for b, g, r, fraction in entries]
+                    for symbol, entries in data["symbols"].items()})
+
+    def save(self, path: str) -> None:
+        # One symbol per line keeps profiles readable and diffable.
+        lines = [f"  {json.dumps(symbol)}: " + json.dumps(
+                     [[*color, round(fraction, 6)]
+                      for color, fraction in entries])
+                 for symbol, entries in self.symbols.items()]
+        with open(path, "w") as file:
+            file.write('{"version": 1, "symbols": {\n' +
+                       ",\n".join(lines) + "\n}}\n")
+
+    def missing(self) -> list[str]:
+        return [symbol for symbol in TILE_SYMBOLS
+                if symbol not in self.symbols]
+
+    def tile_histograms(self, image: MatLike, rows: int, cols: int,
+                        tile_size: int) -> np.ndarray:
+        classes = self.lut[_color_indices(image)]
+        counts = np.empty((rows, cols, self.classes), dtype=np.intp)
+        offsets = (np.arange(cols, dtype=np.intp) *
+                   self.classes)[None, None, :, None]
+        band = max(1, CHUNK_PIXELS // max(cols * tile_size * tile_size, 1))
+        for top in range(0, rows, band):
+            bottom = min(top + band, rows)
+            block = classes[top * tile_size:bottom * tile_size].reshape(
+                bottom - top, tile_size, cols, tile_size)
+            rows_offsets = np.arange(bottom - top, dtype=np.intp) * \
+                cols * self.classes
+            keys = block + offsets + rows_offsets[:, None, None, None]
+            counts[top:bottom] = np.bincount(
+                keys.ravel(), minlength=(bottom - top) * cols * self.classes
+            ).reshape(bottom - top, cols, self.classes)
+        return counts
+
+    def classify_grid(self, image: MatLike, rows: int, cols: int,
+                      tile_size: int) -> np.ndarray:
+        if rows == 0 or cols == 0:
+            return np.zeros((rows, cols), dtype=np.uint8)
+        fractions = self.tile_histograms(image, rows, cols, tile_size) \
+            .reshape(rows * cols, -1) / (tile_size * tile_size)
+        # Squared distances, expanded so the cross term is one product.
+        distances = self.reference_norms[None] - \
+            2 * fractions @ self.references.T
+        return self.codes[distances.argmin(axis=1)].reshape(rows, cols)
+
+
+def load_classifier() -> Classifier:
+    path = os.getenv("PALETTE", "")
+    if not path:
+        return classify_tile_grid
+    profile = PaletteProfile.load(path)
+    if profile.missing():
+        print(f"Palette {path} has no samples for "
+              f"{' '.join(profile.missing())}; those tiles will be misread.")
+    return profile.classify_grid
@@ -0,0 +1,259 @@
+import os
+import time
+from typing import NamedTuple, \
+    TYPE_CHECKING
+import numpy as np
+from common import VICINITY, \
+    UNKNOWN_TILE, \
+    FLAG_TILE
+from frontier import NODE_LIMIT
+from propagation import _too_many_flags
+from solver import Solution, \
+    solve_board
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing.shared_memory import SharedMemory
+
+# Covered tiles per pooled job; smaller regions are packed together.
+MIN_JOB_SIZE = 2000
+# Rows and columns around a region's cells and numbers that a crop keeps,
+# so every number in the region sees all of its neighbors.
+MARGIN = 1
+
+
+class Region(NamedTuple):
+    index: int
+    cells: int
+    bounds: tuple[int, int, int, int]   # top, bottom, left, right
+
+
+class Job(NamedTuple):
+    regions: list[int]
+    bounds: tuple[int, int, int, int]
+    cells: int
+
+
+def independent_regions(board: np.ndarray) \
+        -> tuple[np.ndarray, list[Region]]:
+    # Covered tiles and flags are linked when they share a number; each
+    # linked group can be solved without looking at any other.
+    rows, cols = board.shape
+    width = cols + 2
+    active = np.zeros((rows + 2, width), dtype=bool)
+    active[1:-1, 1:-1] = (board == UNKNOWN_TILE) | (board == FLAG_TILE)
+    ys, xs = np.nonzero((board >= 1) & (board <= 8))
+    ys, xs = ys + 1, xs + 1
+
+    numbers, cells = [], []
+    for j, i in VICINITY:
+        linked = active[ys + i, xs + j]
+        numbers.append(ys[linked] * width + xs[linked])
+        cells.append((ys[linked] + i) * width + xs[linked] + j)
+    numbers = np.concatenate(numbers)
+    cells = np.concatenate(cells)
+
+    # Union-find in bulk: hook every larger root onto the smaller one,
+    # then jump pointers until each node points straight at its root.
+    parent = np.arange(active.size)
+    while True:
+        number_roots, cell_roots = parent[numbers], parent[cells]
+        if np.array_equal(number_roots, cell_roots):
+            break
+        np.minimum.at(parent, np.maximum(number_roots, cell_roots),
+                      np.minimum(number_roots, cell_roots))
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+
+    region_map = np.full(active.size, -1, dtype=np.int32)
+    nodes = np.unique(np.concatenate([numbers, cells]))
+    roots, region_ids = np.unique(parent[nodes], return_inverse=True)
+    region_map[nodes] = region_ids
+    region_map = region_map.reshape(rows + 2, width)[1:-1, 1:-1]
+
+    node_ys, node_xs = np.divmod(nodes, width)
+    order = np.argsort(region_ids, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(region_ids[order]) != 0])
+    node_ys, node_xs = node_ys[order] - 1, node_xs[order] - 1
+    tops = np.maximum(np.minimum.reduceat(node_ys, starts) - MARGIN, 0)
+    bottoms = np.minimum(np.maximum.reduceat(node_ys, starts) + MARGIN + 1,
+                         rows)
+    lefts = np.maximum(np.minimum.reduceat(node_xs, starts) - MARGIN, 0)
+    rights = np.minimum(np.maximum.reduceat(node_xs, starts) + MARGIN + 1,
+                        cols)
+    sizes = np.add.reduceat(active.ravel()[nodes][order].astype(np.intp),
+                            starts)
+    regions = [Region(index, size, (top, bottom, left, right))
+               for index, (size, top, bottom, left, right) in enumerate(zip(
+                   sizes.tolist(), tops.tolist(), bottoms.tolist(),
+                   lefts.tolist(), rights.tolist()))]
+    return region_map, regions
+
+
+def plan_jobs(regions: list[Region], min_size: int) -> list[Job]:
+    # Big regions get a job each; small ones are packed in row order so a
+    # job's crop stays a band rather than spanning the whole board.
+    jobs: list[Job] = []
+    batch: list[Region] = []
+    for region in sorted(regions, key=lambda region: region.bounds):
+        if region.cells >= min_size:
+            jobs.append(Job([region.index], region.bounds, region.cells))
+            continue
+        batch.append(region)
+        if sum(member.cells for member in batch) >= min_size:
+            jobs.append(_pack(batch))
+            batch = []
+    if batch:
+        jobs.append(_pack(batch))
+    return jobs
+
+
+def _pack(batch: list[Region]) -> Job:
+    return Job([region.index for region in batch],
+               (min(region.bounds[0] for region in batch),
+                max(region.bounds[1] for region in batch),
+                min(region.bounds[2] for region in batch),
+                max(region.bounds[3] for region in batch)),
+               sum(region.cells for region in batch))
+
+
+def solve_job(board: np.ndarray, region_map: np.ndarray,
+              output: np.ndarray, tiers: np.ndarray, regions: list[int],
+              bounds: tuple[int, int, int, int],
+              check_flags: bool, node_limit: int,
+              budget: float | None = None) -> bool:
+    top, bottom, left, right = bounds
+    crop = board[top:bottom, left:right].copy()
+    mine = np.isin(region_map[top:bottom, left:right], regions)
+    # Numbers of other regions in the crop may be cut off; dropping them
+    # keeps their partial deductions out of the way.
+    crop[~mine & (crop >= 1) & (crop <= 8)] = 0
+    solution = solve_board(crop, budget, check_flags, node_limit)
+    cells = mine & ((crop == UNKNOWN_TILE) | (crop == FLAG_TILE))
+    output[top:bottom, left:right][cells] = solution.labels[cells]
+    tiers[top:bottom, left:right][cells] = solution.tiers[cells]
+    return solution.complete
+
+
+_attached: dict[str, "SharedMemory"] = {}
+
+
+def _attach(name: str, shape: tuple[int, int], dtype: type) -> np.ndarray:
+    from multiprocessing.shared_memory import SharedMemory
+    if name not in _attached:
+        _attached[name] = SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+
+def _solve_jobs(names: tuple[str, str, str, str], shape: tuple[int, int],
+                jobs: list[Job], check_flags: bool, node_limit: int,
+                deadline: float | None) -> bool:
+    # Blocks for an earlier board size have been released by the parent.
+    for stale in set(_attached) - set(names):
+        _attached.pop(stale).close()
+    board = _attach(names[0], shape, np.uint8)
+    region_map = _attach(names[1], shape, np.int32)
+    output = _attach(names[2], shape, np.uint8)
+    tiers = _attach(names[3], shape, np.uint8)
+    complete = True
+    for job in jobs:
+        # Wall clock, since the deadline was set in another process.
+        budget = None if deadline is None else \
+            max(deadline - time.time(), 0.0)
+        complete &= solve_job(board, region_map, output, tiers,
+                              job.regions, job.bounds, check_flags,
+                              node_limit, budget)
+    return complete
+
+
+class ParallelSolver:
+    def __init__(self, workers: int | None = None,
+                 min_size: int = MIN_JOB_SIZE) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.min_size = min_size
+        # Multiprocessing is only imported once a board is big enough to
+        # need it.
+        self.executor: "ProcessPoolExecutor | None" = None
+        self.blocks: list["SharedMemory"] = []
+        self.shape: tuple[int, int] | None = None
+        self.jobs = 0
+
+    def _allocate(self, shape: tuple[int, int]) -> None:
+        from multiprocessing.shared_memory import SharedMemory
+        self._release()
+        rows, cols = shape
+        self.blocks = [SharedMemory(
+            create=True, size=max(rows * cols * itemsize, 1))
+            for itemsize in (1, 4, 1, 1)]
+        self.shape = shape
+
+    def _release(self) -> None:
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.shape = None
+
+    def solve(self, board: np.ndarray, check_flags: bool = True,
+              node_limit: int = NODE_LIMIT,
+              budget: float | None = None) -> Solution:
+        deadline = None if budget is None else time.time() + budget
+        # The pool matches the serial solve on consistent boards. Crops
+        # visit numbers in another order than the whole board does, which
+        # changes the result where misplaced flags make rules contradict
+        # each other, so boards with an over-flagged number stay serial.
+        jobs = []
+        if not _too_many_flags(board).any():
+            region_map, regions = independent_regions(board)
+            jobs = plan_jobs(regions, self.min_size)
+        if len(jobs) < 2:
+            if deadline is not None:
+                budget = max(deadline - time.time(), 0.0)
+            return solve_board(board, budget, check_flags, node_limit)
+
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            # Spawned rather than forked, since the bot may be running
+            # capture and click threads.
+            self.executor = ProcessPoolExecutor(
+                self.workers, multiprocessing.get_context("spawn"))
+        if self.shape != board.shape:
+            self._allocate(board.shape)
+        shared_board, shared_map, output, tiers = (
+            np.ndarray(board.shape, dtype=dtype, buffer=block.buf)
+            for block, dtype in zip(self.blocks,
+                                    (np.uint8, np.int32, np.uint8,
+                                     np.uint8)))
+        shared_board[:] = board
+        shared_map[:] = region_map
+        output[:] = 0
+        tiers[:] = 0
+        names = tuple(block.name for block in self.blocks)
+
+        # Biggest jobs first, so the longest ones start earliest.
+        jobs.sort(key=lambda job: job.cells, reverse=True)
+        futures = [self.executor.submit(_solve_jobs, names, board.shape,
+                                        [job], check_flags, node_limit,
+                                        deadline)
+                   for job in jobs]
+        complete = all([future.result() for future in futures])
+        self.jobs += len(jobs)
+        return Solution(output.copy(), tiers.copy(), complete)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self._release()
+
+
+def load_parallel() -> ParallelSolver | None:
+    workers = int(os.getenv("PARALLEL_WORKERS", 0))
+    if workers <= 0:
+        return None
+    return ParallelSolver(workers, int(os.getenv("PARALLEL_MIN_REGION",
+                                                 MIN_JOB_SIZE)))
@@ -0,0 +1,128 @@
+import heapq
+import numpy as np
+from common import VICINITY, \
+    UNKNOWN_TILE, \
+    neighbor_counts
+
+Point = tuple[float, float]
+Position = tuple[int, int]
+
+# 2-opt is quadratic per pass, so huge batches keep the greedy tour.
+TWO_OPT_LIMIT = 500
+TWO_OPT_PASSES = 8
+
+# A chord that opens a single tile is no better than revealing it.
+MIN_CHORD_CELLS = 2
+
+
+def travel_distance(points: np.ndarray, order: np.ndarray,
+                    start: Point | None = None) -> float:
+    if len(order) == 0:
+        return 0.0
+    path = points[order]
+    if start is not None:
+        path = np.vstack([np.array(start, dtype=np.float64), path])
+    return float(np.hypot(*np.diff(path, axis=0).T).sum())
+
+
+def nearest_neighbor_order(points: np.ndarray,
+                           start: Point | None = None) -> np.ndarray:
+    count = len(points)
+    order = np.empty(count, dtype=np.intp)
+    if count == 0:
+        return order
+    visited = np.zeros(count, dtype=bool)
+    if start is None:
+        # Without a known cursor position, begin at the top-left action.
+        current = int(np.lexsort((points[:, 0], points[:, 1]))[0])
+    else:
+        current = int(np.argmin(
+            np.hypot(*(points - np.array(start)).T)))
+    for index in range(count):
+        order[index] = current
+        visited[current] = True
+        if index + 1 == count:
+            break
+        distances = np.hypot(*(points - points[current]).T)
+        distances[visited] = np.inf
+        current = int(np.argmin(distances))
+    return order
+
+
+def two_opt(points: np.ndarray, order: np.ndarray,
+            start: Point | None = None,
+            passes: int = TWO_OPT_PASSES) -> np.ndarray:
+    # The tour is an open path from the cursor, so reversing a segment
+    # that reaches the end only changes the edge going into it.
+    order = order.copy()
+    count = len(order)
+    if count < 3:
+        return order
+    # Without a cursor position the first action stays where it is.
+    first = 0 if start is not None else 1
+    for _ in range(passes):
+        improved = False
+        for i in range(first, count - 1):
+            path = points[order]
+            before = np.array(start, dtype=np.float64) if i == 0 \
+                else path[i - 1]
+            ends = path[i + 1:]
+            after = np.vstack([path[i + 2:], np.full((1, 2), np.nan)])
+            old = np.hypot(*(path[i] - before)) + \
+                np.nan_to_num(np.hypot(*(ends - after).T))
+            new = np.hypot(*(ends - before).T) + \
+                np.nan_to_num(np.hypot(*(path[i] - after).T))
+            gains = old - new
+            j = int(np.argmax(gains))
+            if gains[j] > 1e-9:
+                order[i:i + j + 2] = order[i:i + j + 2][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def plan_tour(points: np.ndarray,
+              start: Point | None = None) -> np.ndarray:
+    order = nearest_neighbor_order(points, start)
+    if len(order) <= TWO_OPT_LIMIT:
+        order = two_opt(points, order, start)
+    return order
+
+
+def plan_chords(board: np.ndarray,
+                safe: np.ndarray,
+                flags: np.ndarray) -> tuple[list[Position], np.ndarray]:
+    # Clicking a number whose flags already match it opens every other
+    # covered neighbor, so one chord can stand in for several reveals.
+    rows, cols = board.shape
+    covered = (board == UNKNOWN_TILE) & ~flags
+    covered_counts = neighbor_counts(covered)
+    satisfied = (board >= 1) & (board <= 8) & \
+        (neighbor_counts(flags) == board) & \
+        (covered_counts == neighbor_counts(covered & safe)) & \
+        (covered_counts >= MIN_CHORD_CELLS)
+
+    candidates = np.argwhere(satisfied).tolist()
+    cells = [[(y + i, x + j) for j, i in VICINITY
+              if 0 <= y + i < rows and 0 <= x + j < cols and
+              covered[y + i, x + j]] for y, x in candidates]
+
+    # Greedy set cover; gains only shrink, so stale heap entries are
+    # re-scored when popped instead of rescanning every candidate.
+    heap = [(-len(members), index) for index, members in enumerate(cells)]
+    heapq.heapify(heap)
+    opened = np.zeros_like(covered)
+    chords: list[Position] = []
+    while heap:
+        stored, index = heapq.heappop(heap)
+        gain = sum(not opened[cell] for cell in cells[index])
+        if gain < MIN_CHORD_CELLS:
+            continue
+        if gain != -stored:
+            heapq.heappush(heap, (-gain, index))
+            continue
+        chords.append(tuple(candidates[index]))
+        for cell in cells[index]:
+            opened[cell] = True
+    return chords, opened
@@ -0,0 +1,64 @@
+import os
+import zlib
+import numpy as np
+from cv2.typing import MatLike
+
+GridCoords = tuple[list[int], list[int]]
+
+# Every poll the unchanged board is seen, the delay grows by this factor
+# until it reaches IDLE_MAX_DELAY milliseconds.
+IDLE_BACKOFF = 2.0
+IDLE_MAX_DELAY = 500
+# Pixels sampled per tile side; anything that changes a tile (opening it,
+# flagging it) covers more than a quarter of it.
+SAMPLES_PER_TILE = 4
+
+
+def board_signature(image: MatLike, field_grid: GridCoords) -> int:
+    x_coords, y_coords = field_grid
+    tile_size = y_coords[1] - y_coords[0]
+    step = max(1, tile_size // SAMPLES_PER_TILE)
+    sample = image[y_coords[0]:y_coords[-1]:step,
+                   x_coords[0]:x_coords[-1]:step]
+    return zlib.crc32(np.ascontiguousarray(sample))
+
+
+class IdlePoller:
+    def __init__(self, delay: int, max_delay: int = IDLE_MAX_DELAY,
+                 backoff: float = IDLE_BACKOFF) -> None:
+        # cv.waitKey(0) blocks for good, so the delay never drops below 1.
+        self.min_delay = max(delay, 1)
+        self.max_delay = max(max_delay, self.min_delay)
+        self.backoff = backoff
+        self.delay = self.min_delay
+        self.signature: int | None = None
+        self.analyzed = 0
+        self.skipped = 0
+
+    def changed(self, signature: int) -> bool:
+        if signature == self.signature:
+            self.skipped += 1
+            self.delay = min(max(int(self.delay * self.backoff),
+                                 self.delay + 1), self.max_delay)
+            return False
+        self.signature = signature
+        self.analyzed += 1
+        self.delay = self.min_delay
+        return True
+
+    def invalidate(self) -> None:
+        # The next frame is analyzed whatever it looks like.
+        self.signature = None
+        self.delay = self.min_delay
+
+    def report(self) -> None:
+        total = self.analyzed + self.skipped
+        if total:
+            print(f"Frames: {self.analyzed} analyzed, {self.skipped} skipped "
+                  f"({self.skipped / total:.0%} idle).")
+
+
+def load_poller(check_delay: int) -> IdlePoller:
+    return IdlePoller(check_delay,
+                      int(os.getenv("IDLE_MAX_DELAY", IDLE_MAX_DELAY)),
+                      float(os.getenv("IDLE_BACKOFF", IDLE_BACKOFF)))
@@ -0,0 +1,209 @@
+from collections import OrderedDict
+import math
+import threading
+import numpy as np
+from common import UNKNOWN_TILE, \
+    FLAG_TILE
+from propagation import SAFE, \
+    DANGEROUS
+from frontier import Component, \
+    ComponentSolver, \
+    frontier_components, \
+    NODE_LIMIT
+
+Position = tuple[int, int]
+Signature = tuple[tuple[Position, ...],
+                  tuple[tuple[tuple[int, ...], int], ...]]
+Tally = tuple[np.ndarray, np.ndarray]
+
+# (rows, cols) -> mines for the standard Minesweeper Online boards.
+STANDARD_BOARDS = {(9, 9): 10, (16, 16): 40, (16, 30): 99}
+DEFAULT_DENSITY = 99 / (16 * 30)
+CACHE_SIZE = 4096
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Boards may be solved from several threads at once.
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+component_cache = LRUCache()
+
+
+def board_mine_count(rows: int, cols: int) -> int:
+    return STANDARD_BOARDS.get((rows, cols),
+                               round(rows * cols * DEFAULT_DENSITY))
+
+
+def component_signature(component: Component) \
+        -> tuple[Signature, Position]:
+    # Cells are shifted to the component's top-left corner and sorted, so
+    # the same constraint pattern anywhere on the board shares one entry.
+    top = min(y for y, _ in component.cells)
+    left = min(x for _, x in component.cells)
+    order = sorted(range(len(component.cells)),
+                   key=lambda i: component.cells[i])
+    new_ids = {old: new for new, old in enumerate(order)}
+    cells = tuple((y - top, x - left) for y, x in
+                  (component.cells[i] for i in order))
+    constraints = tuple(sorted(
+        (tuple(sorted(new_ids[member] for member in members)), need)
+        for members, need in component.constraints))
+    return (cells, constraints), (top, left)
+
+
+def tally_component(signature: Signature,
+                    node_limit: int = NODE_LIMIT) -> Tally | None:
+    cached = component_cache.get(signature)
+    if cached is not None:
+        return cached or None
+    cells, constraints = signature
+    component = Component(list(cells),
+                          [(list(members), need)
+                           for members, need in constraints])
+    result = ComponentSolver(component).tally(node_limit)
+    if result is None:
+        # Remembered as a miss so oversized components aren't retried.
+        component_cache.put(signature, ())
+        return None
+    counts, cell_counts = result
+    tally = (np.array(counts, dtype=np.float64),
+             np.array(cell_counts, dtype=np.float64))
+    component_cache.put(signature, tally)
+    return tally
+
+
+def _local_estimate(component: Component) -> np.ndarray:
+    totals = np.zeros(len(component.cells))
+    seen = np.zeros(len(component.cells))
+    for members, need in component.constraints:
+        totals[members] += need / len(members)
+        seen[members] += 1
+    return np.clip(totals / np.maximum(seen, 1), 0, 1)
+
+
+def _log_comb(n: int, k: np.ndarray) -> np.ndarray:
+    result = np.full(len(k), -np.inf)
+    valid = (k >= 0) & (k <= n)
+    result[valid] = [math.lgamma(n + 1) - math.lgamma(i + 1) -
+                     math.lgamma(n - i + 1) for i in k[valid]]
+    return result
+
+
+def mine_probabilities(board: np.ndarray,
+                       labels: np.ndarray | None = None,
+                       total_mines: int | None = None,
+                       node_limit: int = NODE_LIMIT) -> np.ndarray:
+    rows, cols = board.shape
+    if labels is None:
+        labels = np.zeros_like(board)
+    if total_mines is None:
+        total_mines = board_mine_count(rows, cols)
+
+    probabilities = np.full((rows, cols), np.nan)
+    unknown = board == UNKNOWN_TILE
+    probabilities[unknown & (labels == SAFE)] = 0.0
+    probabilities[unknown & (labels == DANGEROUS)] = 1.0
+    open_cells = unknown & (labels != SAFE) & (labels != DANGEROUS)
+    remaining = total_mines - int(np.count_nonzero(board == FLAG_TILE)) - \
+        int(np.count_nonzero(unknown & (labels == DANGEROUS)))
+
+    exact: list[tuple[list[Position], Tally]] = []
+    frontier = np.zeros((rows, cols), dtype=bool)
+    for component in frontier_components(board, labels):
+        for y, x in component.cells:
+            frontier[y, x] = True
+        signature, (top, left) = component_signature(component)
+        tally = None
+        if all(0 <= need <= len(members)
+               for members, need in component.constraints):
+            tally = tally_component(signature, node_limit)
+        if tally is None or not tally[0].any():
+            estimate = _local_estimate(component)
+            for (y, x), probability in zip(component.cells, estimate):
+                probabilities[y, x] = probability
+            remaining -= int(round(estimate.sum()))
+            continue
+        cells = [(y + top, x + left) for y, x in signature[0]]
+        exact.append((cells, tally))
+
+    others = int(np.count_nonzero(open_cells & ~frontier))
+    distributions = [counts / counts.max() for _, (counts, _) in exact]
+    prefix = [np.ones(1)]
+    for distribution in distributions:
+        prefix.append(np.convolve(prefix[-1], distribution))
+    suffix = [np.ones(1)]
+    for distribution in reversed(distributions):
+        suffix.append(np.convolve(suffix[-1], distribution))
+    suffix.reverse()
+
+    # weights[t]: relative number of ways to place the mines left over
+    # when the frontier holds t of them.
+    frontier_mines = np.arange(len(prefix[-1]))
+    log_weights = _log_comb(others, remaining - frontier_mines)
+    if np.isfinite(log_weights).any():
+        weights = np.exp(log_weights - log_weights[np.isfinite(
+            log_weights)].max())
+    else:
+        # The mine count doesn't fit this board; fall back to the
+        # frontier constraints alone.
+        weights = np.ones(len(frontier_mines))
+
+    for index, (cells, (counts, cell_counts)) in enumerate(exact):
+        rest = np.convolve(prefix[index], suffix[index + 1])
+        scale = counts.max()
+        outer = np.array([rest @ weights[k:k + len(rest)]
+                          for k in range(len(counts))])
+        total = (counts / scale) @ outer
+        if total <= 0:
+            outer = np.ones(len(counts))
+            total = (counts / scale) @ outer
+        cell_probabilities = (cell_counts / scale).T @ outer / total
+        for (y, x), probability in zip(cells, cell_probabilities):
+            probabilities[y, x] = probability
+
+    if others:
+        everything = prefix[-1] * weights
+        if everything.sum() > 0:
+            expected = everything @ (remaining - frontier_mines) / \
+                everything.sum()
+        else:
+            expected = remaining - prefix[-1] @ frontier_mines / \
+                prefix[-1].sum()
+        probabilities[open_cells & ~frontier] = \
+            float(np.clip(expected / others, 0, 1))
+    return probabilities
+
+
+def lowest_risk_tile(board: np.ndarray,
+                     probabilities: np.ndarray) -> Position | None:
+    candidates = np.where(board == UNKNOWN_TILE, probabilities, np.nan)
+    if np.isnan(candidates).all():
+        return None
+    y, x = np.unravel_index(np.nanargmin(candidates), candidates.shape)
+    return int(y), int(x)
@@ -0,0 +1,196 @@
+import time
+from collections import deque
+import numpy as np
+from common import VICINITY, \
+    UNKNOWN_TILE, \
+    FLAG_TILE, \
+    neighbor_counts
+
+NO_LABEL = 0
+WRONG_FLAG = 1
+SAFE = 2
+DANGEROUS = 3
+WRONG_FLAG_NEAR = 4
+
+OUTSIDE = 255
+# Numbers examined between two looks at the clock.
+DEADLINE_CHECK = 1024
+# Whole-board passes stop once one changes fewer tiles than this; the
+# worklist finishes the rest around them.
+SWEEP_MIN_CHANGES = 64
+
+
+def labels_to_strings(labels: np.ndarray) -> list[str]:
+    digits = labels + ord("0")
+    return [row.tobytes().decode() for row in digits]
+
+
+def labels_from_strings(hint: list[str]) -> np.ndarray:
+    if not hint:
+        return np.zeros((0, 0), dtype=np.uint8)
+    raw = np.frombuffer("".join(hint).encode(), dtype=np.uint8)
+    return (raw - ord("0")).reshape(len(hint), -1)
+
+
+def _evaluate_tile(index: int,
+                   cells: list[int],
+                   hint: bytearray,
+                   offsets: list[int],
+                   check_flags: bool) -> list[tuple[int, int]]:
+    around = [index + offset for offset in offsets]
+    changes: list[tuple[int, int]] = []
+    num_mines = cells[index]
+
+    flags = [i for i in around if cells[i] == FLAG_TILE]
+    unknowns = [i for i in around if cells[i] == UNKNOWN_TILE]
+    num_dangerous = sum(1 for i in around if
+                        hint[i] == DANGEROUS or hint[i] == WRONG_FLAG_NEAR)
+    num_safe = sum(1 for i in around if hint[i] == SAFE)
+    num_correct_flags = 0
+
+    if check_flags and len(flags) > num_mines:
+        changes.extend((i, WRONG_FLAG) for i in flags if hint[i] == NO_LABEL)
+    else:
+        num_correct_flags = sum(1 for i in flags if hint[i] == NO_LABEL)
+
+    if num_correct_flags == num_mines:
+        changes.extend((i, SAFE) for i in unknowns if hint[i] != SAFE)
+    if num_correct_flags + num_dangerous == num_mines:
+        changes.extend((i, SAFE) for i in unknowns if hint[i] == NO_LABEL)
+
+    if len(unknowns) - num_safe + len(flags) == num_mines:
+        changes.extend((i, DANGEROUS) for i in unknowns if
+                       hint[i] == NO_LABEL)
+        if check_flags:
+            changes.extend((i, WRONG_FLAG_NEAR) for i in flags if
+                           hint[i] == WRONG_FLAG)
+    return changes
+
+
+def _expired(deadline: float | None) -> bool:
+    return deadline is not None and time.perf_counter() >= deadline
+
+
+def _too_many_flags(board: np.ndarray) -> np.ndarray:
+    return (board >= 1) & (board <= 8) & \
+        (neighbor_counts(board == FLAG_TILE) > board)
+
+
+def sweep(board: np.ndarray, labels: np.ndarray,
+          check_flags: bool = True) -> np.ndarray:
+    # The rules of _evaluate_tile for every number at once. All numbers
+    # see the labels as they were before the pass, so chains take several
+    # passes; returns the tiles whose label changed.
+    values = board.astype(np.int16)
+    numbers = (board >= 1) & (board <= 8)
+    flags = board == FLAG_TILE
+    unknowns = board == UNKNOWN_TILE
+    unlabeled = labels == NO_LABEL
+    safe = labels == SAFE
+    num_flags = neighbor_counts(flags)
+    num_correct_flags = neighbor_counts(flags & unlabeled).astype(np.int16)
+    num_dangerous = neighbor_counts((labels == DANGEROUS) |
+                                    (labels == WRONG_FLAG_NEAR))
+    num_open = neighbor_counts(unknowns & ~safe)
+
+    # Flags around a number with too many of them were marked wrong
+    # before the first pass, and aren't counted as correct.
+    if check_flags:
+        num_correct_flags[_too_many_flags(board)] = 0
+    result = labels.copy()
+    cleared = numbers & (num_correct_flags == values)
+    result[unknowns & ~safe & (neighbor_counts(cleared) > 0)] = SAFE
+    cleared = numbers & (num_correct_flags + num_dangerous == values)
+    result[unknowns & unlabeled & (neighbor_counts(cleared) > 0)] = SAFE
+    filled = neighbor_counts(numbers & (num_open + num_flags == values)) > 0
+    result[unknowns & (result == NO_LABEL) & filled] = DANGEROUS
+    if check_flags:
+        result[flags & (result == WRONG_FLAG) & filled] = WRONG_FLAG_NEAR
+
+    changed = result != labels
+    labels[:] = result
+    return changed
+
+
+def propagate(board: np.ndarray,
+              labels: np.ndarray | None = None,
+              check_flags: bool = True,
+              deadline: float | None = None,
+              changed: np.ndarray | None = None) -> np.ndarray:
+    labels = np.zeros(board.shape, dtype=np.uint8) if labels is None \
+        else labels.copy()
+    # Whole-board passes already mark every over-flagged number's flags.
+    swept = changed is None
+    if changed is None:
+        if check_flags:
+            labels[(board == FLAG_TILE) & (labels == NO_LABEL) &
+                   (neighbor_counts(_too_many_flags(board)) > 0)] = \
+                WRONG_FLAG
+        # Whole-board passes settle the bulk of the board with array
+        # operations; the worklist takes over around the last changes.
+        while True:
+            if _expired(deadline):
+                return labels
+            changed = sweep(board, labels, check_flags)
+            if np.count_nonzero(changed) < SWEEP_MIN_CHANGES:
+                break
+    # Setting up the worklist costs a pass over the whole board, which an
+    # expired budget can't afford.
+    if _expired(deadline):
+        return labels
+
+    rows, cols = board.shape
+    width = cols + 2
+    padded = np.full((rows + 2, width), OUTSIDE, dtype=np.uint8)
+    padded[1:-1, 1:-1] = board
+    cells: list[int] = padded.ravel().tolist()
+    # Labels carried over were settled already; only numbers next to the
+    # tiles that changed since can tell anything new.
+    is_number = (padded >= 1) & (padded <= 8)
+    is_number[1:-1, 1:-1] &= neighbor_counts(changed) > 0
+    numbers = np.flatnonzero(is_number).tolist()
+    padded[1:-1, 1:-1] = labels
+    padded[0, :] = padded[-1, :] = padded[:, 0] = padded[:, -1] = NO_LABEL
+    hint = bytearray(padded.tobytes())
+    offsets = [i * width + j for j, i in VICINITY]
+    if check_flags and not swept:
+        for index in numbers:
+            flags = [index + offset for offset in offsets
+                     if cells[index + offset] == FLAG_TILE]
+            if len(flags) > cells[index]:
+                for i in flags:
+                    if hint[i] == NO_LABEL:
+                        hint[i] = WRONG_FLAG
+
+    # Only the numbers around a tile whose label just changed can
+    # produce new deductions, so those are the only ones re-examined.
+    # Misplaced flags can make numbers disagree on a tile, and the last
+    # one examined decides it: on such boards the labels depend on the
+    # order numbers are visited, and may differ from a row-by-row sweep.
+    queue = deque(numbers)
+    queued = bytearray(len(cells))
+    for index in numbers:
+        queued[index] = 1
+    steps = 0
+    while queue:
+        steps += 1
+        if deadline is not None and not steps % DEADLINE_CHECK and \
+                time.perf_counter() >= deadline:
+            break
+        index = queue.popleft()
+        queued[index] = 0
+        changed = []
+        for i, new_label in _evaluate_tile(index, cells, hint, offsets,
+                                           check_flags):
+            if hint[i] != new_label:
+                hint[i] = new_label
+                changed.append(i)
+        for i in changed:
+            for offset in offsets:
+                neighbor = i + offset
+                if 1 <= cells[neighbor] <= 8 and not queued[neighbor]:
+                    queued[neighbor] = 1
+                    queue.append(neighbor)
+
+    result = np.frombuffer(bytes(hint), dtype=np.uint8)
+    return result.reshape(rows + 2, width)[1:-1, 1:-1].copy()
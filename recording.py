@@ -0,0 +1,149 @@
+import json
+import os
+import struct
+import time
+from typing import Iterator, NamedTuple
+import numpy as np
+
+GridCoords = tuple[list[int], list[int]]
+
+# A recording is a magic string followed by chunks. Every chunk has a
+# 16 byte header (kind, reserved, payload length) and its payload is
+# padded to 8 bytes, so arrays can be viewed straight out of a memory map.
+MAGIC = b"MSREC\x00\x01\x00"
+CHUNK_HEADER = struct.Struct("<4sIQ")
+# timestamp, rows, cols, tile size (0 without pixels), reserved
+FRAME_HEADER = struct.Struct("<dIIII")
+
+META = b"META"
+GRID = b"GRID"
+FRAME = b"FRAM"
+
+
+class RecordedFrame(NamedTuple):
+    timestamp: float
+    board: np.ndarray
+    labels: np.ndarray
+    grid: GridCoords | None
+    pixels: np.ndarray | None
+
+
+def _padding(length: int) -> int:
+    return -length % 8
+
+
+class Recorder:
+    def __init__(self, path: str, source: str,
+                 store_pixels: bool = False) -> None:
+        self.file = open(path, "wb")
+        self.store_pixels = store_pixels
+        self.grid: GridCoords | None = None
+        self.frames = 0
+        self.file.write(MAGIC)
+        self._write_chunk(META, json.dumps(
+            {"source": source, "created": time.time(),
+             "pixels": store_pixels}).encode())
+
+    def _write_chunk(self, kind: bytes, *parts: bytes) -> None:
+        length = sum(len(part) for part in parts)
+        self.file.write(CHUNK_HEADER.pack(kind, 0, length))
+        for part in parts:
+            self.file.write(part)
+        self.file.write(bytes(_padding(length)))
+
+    def write(self, board: np.ndarray, labels: np.ndarray,
+              field_grid: GridCoords,
+              image: np.ndarray | None = None) -> None:
+        if field_grid != self.grid:
+            self.grid = field_grid
+            self._write_chunk(GRID, json.dumps(
+                {"x_coords": [int(x) for x in field_grid[0]],
+                 "y_coords": [int(y) for y in field_grid[1]]}).encode())
+
+        rows, cols = board.shape
+        parts = [np.ascontiguousarray(board, dtype=np.uint8).tobytes(),
+                 np.ascontiguousarray(labels, dtype=np.uint8).tobytes()]
+        tile_size = 0
+        x_coords, y_coords = field_grid
+        if self.store_pixels and image is not None:
+            tile_size = y_coords[1] - y_coords[0]
+            pixels = image[y_coords[0]:y_coords[0] + rows * tile_size,
+                           x_coords[0]:x_coords[0] + cols * tile_size]
+            if pixels.shape[:2] == (rows * tile_size, cols * tile_size):
+                parts.append(np.ascontiguousarray(pixels).tobytes())
+            else:
+                tile_size = 0
+        header = FRAME_HEADER.pack(time.time(), rows, cols, tile_size, 0)
+        self._write_chunk(FRAME, header, *parts)
+        self.frames += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "Recorder":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def load_recorder(source: str) -> Recorder | None:
+    path = os.getenv("RECORD", "")
+    if not path:
+        return None
+    return Recorder(path, source, int(os.getenv("RECORD_PIXELS", 0)) != 0)
+
+
+class Recording:
+    def __init__(self, path: str) -> None:
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a board recording")
+        self.meta: dict = {}
+        self.grids: list[GridCoords] = []
+        # (payload offset, index into self.grids) per frame
+        self.index: list[tuple[int, int]] = []
+
+        offset = len(MAGIC)
+        while offset + CHUNK_HEADER.size <= len(self.data):
+            kind, _, length = CHUNK_HEADER.unpack_from(self.data, offset)
+            start = offset + CHUNK_HEADER.size
+            if start + length > len(self.data):
+                # A session cut short leaves a partial chunk behind.
+                break
+            if kind == META:
+                self.meta = json.loads(bytes(self.data[start:start + length]))
+            elif kind == GRID:
+                grid = json.loads(bytes(self.data[start:start + length]))
+                self.grids.append((grid["x_coords"], grid["y_coords"]))
+            elif kind == FRAME:
+                self.index.append((start, len(self.grids) - 1))
+            offset = start + length + _padding(length)
+
+    @property
+    def source(self) -> str:
+        return self.meta.get("source", "bot")
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, index: int) -> RecordedFrame:
+        start, grid_index = self.index[index]
+        timestamp, rows, cols, tile_size, _ = \
+            FRAME_HEADER.unpack_from(self.data, start)
+        start += FRAME_HEADER.size
+        size = rows * cols
+        board = self.data[start:start + size].reshape(rows, cols)
+        labels = self.data[start + size:start + 2 * size].reshape(rows, cols)
+        pixels = None
+        if tile_size:
+            start += 2 * size
+            length = size * tile_size * tile_size * 3
+            pixels = self.data[start:start + length].reshape(
+                rows * tile_size, cols * tile_size, 3)
+        grid = self.grids[grid_index] if grid_index >= 0 else None
+        return RecordedFrame(timestamp, board, labels, grid, pixels)
+
+    def __iter__(self) -> Iterator[RecordedFrame]:
+        for index in range(len(self)):
+            yield self[index]
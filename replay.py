@@ -0,0 +1,110 @@
+import argparse
+import sys
+import time
+from typing import Callable
+import numpy as np
+from common import board_to_strings, \
+    classify_tile_grid
+from propagation import labels_from_strings
+from recording import Recording
+from palette import PaletteProfile
+import bot
+import hint
+
+SOLVERS: dict[str, Callable[[list[str]], list[str]]] = {
+    "bot": bot.generate_hint_map,
+    "hint": hint.generate_hint_map}
+
+
+def report(stage: str, frames: int, seconds: float,
+           changed: list[int], tiles: int) -> None:
+    rate = frames / seconds if seconds else float("inf")
+    print(f"{stage}: {frames} frames in {seconds:.3f} s "
+          f"({rate:.0f} frames/s), {len(changed)} frames changed "
+          f"({tiles} tiles)")
+    if changed:
+        print(f"    first changed frames: "
+              f"{', '.join(map(str, changed[:10]))}")
+
+
+def replay_solver(recording: Recording, solver: str,
+                  repeats: int) -> bool:
+    generate_hint_map = SOLVERS[solver]
+    # Strings are built up front so only the solver is timed.
+    minefields = [board_to_strings(frame.board) for frame in recording]
+    changed: list[int] = []
+    tiles = 0
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        for index, minefield in enumerate(minefields):
+            labels = labels_from_strings(generate_hint_map(minefield))
+            if repeat == 0:
+                difference = np.count_nonzero(
+                    labels != recording[index].labels)
+                if difference:
+                    changed.append(index)
+                    tiles += difference
+    seconds = time.perf_counter() - start
+    report(f"solve ({solver})", len(minefields) * repeats, seconds,
+           changed, tiles)
+    return not changed
+
+
+def replay_parser(recording: Recording, repeats: int,
+                  palette: str | None = None) -> bool:
+    classify = PaletteProfile.load(palette).classify_grid \
+        if palette else classify_tile_grid
+    frames = [(index, frame) for index, frame in enumerate(recording)
+              if frame.pixels is not None]
+    if not frames:
+        print("parse: the recording holds no tile pixels")
+        return True
+    changed: list[int] = []
+    tiles = 0
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        for index, frame in frames:
+            rows, cols = frame.board.shape
+            board = classify(frame.pixels, rows, cols,
+                             frame.pixels.shape[0] // rows)
+            if repeat == 0:
+                difference = np.count_nonzero(board != frame.board)
+                if difference:
+                    changed.append(index)
+                    tiles += difference
+    seconds = time.perf_counter() - start
+    report("parse", len(frames) * repeats, seconds, changed, tiles)
+    return not changed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Feed a recorded session through the parser and "
+                    "solver, timing them and reporting any frame whose "
+                    "result differs from the recording.")
+    parser.add_argument("recording")
+    parser.add_argument("--mode", choices=["solve", "parse", "all"],
+                        default="all")
+    parser.add_argument("--solver", choices=list(SOLVERS),
+                        help="solver to replay (default: the one that "
+                             "made the recording)")
+    parser.add_argument("--palette", metavar="PROFILE",
+                        help="parse with a calibrated palette profile "
+                             "instead of the built-in color ranges")
+    parser.add_argument("--repeats", type=int, default=1)
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    print(f"{args.recording}: {len(recording)} frames recorded by "
+          f"{recording.source}.py")
+    unchanged = True
+    if args.mode in ("parse", "all"):
+        unchanged &= replay_parser(recording, args.repeats, args.palette)
+    if args.mode in ("solve", "all"):
+        unchanged &= replay_solver(recording, args.solver or
+                                   recording.source, args.repeats)
+    sys.exit(0 if unchanged else 1)
+
+
+if __name__ == "__main__":
+    main()
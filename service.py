@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, \
+    Iterable, \
+    TYPE_CHECKING
+import numpy as np
+from common import TILE_SYMBOLS, \
+    board_from_strings
+from probability import mine_probabilities
+from propagation import labels_from_strings
+import bot
+import hint
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+SOLVERS: dict[str, Callable[[list[str]], list[str]]] = {
+    "bot": bot.generate_hint_map,
+    "hint": hint.generate_hint_map}
+
+# Requests handed to a worker at once, and how long the first request of a
+# batch waits for others to join it.
+BATCH_SIZE = 32
+BATCH_WAIT = 0.002
+# Batches queued per worker, so requests pile up into bigger batches
+# instead of the pool's queue while every worker is busy.
+BATCHES_PER_WORKER = 2
+# The probability engine is too slow to run on every huge board.
+PROBABILITY_LIMIT = 40000
+PROBABILITY_DIGITS = 4
+
+
+def _check_board(minefield: object) -> list[str]:
+    if not isinstance(minefield, list) or \
+            not all(isinstance(row, str) for row in minefield):
+        raise ValueError("board must be a list of strings")
+    if minefield and len(set(map(len, minefield))) != 1:
+        raise ValueError("board rows differ in length")
+    unknown = set("".join(minefield)) - set(TILE_SYMBOLS)
+    if unknown:
+        raise ValueError(f"board holds unknown symbols: "
+                         f"{''.join(sorted(unknown))}")
+    return minefield
+
+
+def solve_request(request: dict) -> dict:
+    try:
+        minefield = _check_board(request.get("board"))
+        solver = request.get("solver", "hint")
+        if solver not in SOLVERS:
+            raise ValueError(f"unknown solver: {solver!r}")
+        start = time.perf_counter()
+        hint_map = SOLVERS[solver](minefield)
+        board = board_from_strings(minefield)
+        probabilities = None
+        if request.get("probabilities", True) and \
+                board.size <= PROBABILITY_LIMIT:
+            values = mine_probabilities(board, labels_from_strings(hint_map),
+                                        request.get("total_mines"))
+            probabilities = np.where(
+                np.isnan(values), None,
+                np.round(values, PROBABILITY_DIGITS)).tolist()
+        solve_ms = (time.perf_counter() - start) * 1000
+    except (TypeError, ValueError) as error:
+        # Nothing solved so far goes out with the error.
+        return {"id": request.get("id"), "error": str(error)}
+    return {"id": request.get("id"),
+            "hint": hint_map,
+            "probabilities": probabilities,
+            "solve_ms": solve_ms}
+
+
+def solve_batch(requests: list[dict]) -> list[dict]:
+    return [solve_request(request) for request in requests]
+
+
+class BatchSolver:
+    def __init__(self, workers: int = 0,
+                 batch_size: int = BATCH_SIZE,
+                 batch_wait: float = BATCH_WAIT) -> None:
+        self.batch_size = max(batch_size, 1)
+        self.batch_wait = batch_wait
+        self.requests: queue.Queue = queue.Queue()
+        self.executor: "ProcessPoolExecutor | None" = None
+        self.slots = threading.Semaphore(BATCHES_PER_WORKER * max(workers, 1))
+        if workers > 0:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            self.executor = ProcessPoolExecutor(
+                workers, multiprocessing.get_context("spawn"))
+            # Workers import the solvers before the first request arrives.
+            for future in [self.executor.submit(solve_batch, [])
+                           for _ in range(workers)]:
+                future.result()
+        self.batches = 0
+        self.boards = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: dict) -> Future:
+        future: Future = Future()
+        self.requests.put((request, future))
+        return future
+
+    def _collect(self) -> list[tuple[dict, Future]] | None:
+        item = self.requests.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.perf_counter() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                item = self.requests.get(
+                    timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self) -> None:
+        while True:
+            # A batch is only gathered once a worker can take it.
+            self.slots.acquire()
+            batch = self._collect()
+            if batch is None:
+                self.slots.release()
+                return
+            self.batches += 1
+            self.boards += len(batch)
+            requests = [request for request, _ in batch]
+            if self.executor is None:
+                try:
+                    self._resolve(batch, solve_batch(requests), None)
+                except Exception as error:
+                    self._resolve(batch, None, error)
+                continue
+            try:
+                future = self.executor.submit(solve_batch, requests)
+            except Exception as error:
+                # A broken pool fails this batch, not the thread that
+                # feeds every later one.
+                self._resolve(batch, None, error)
+                continue
+            future.add_done_callback(
+                lambda done, batch=batch: self._resolve(
+                    batch, None if done.exception() else done.result(),
+                    done.exception()))
+
+    def _resolve(self, batch: list[tuple[dict, Future]],
+                 responses: list[dict] | None,
+                 error: BaseException | None) -> None:
+        self.slots.release()
+        for index, (request, future) in enumerate(batch):
+            if responses is not None:
+                future.set_result(responses[index])
+            else:
+                future.set_result({"id": request.get("id"),
+                                   "error": f"solver failed: {error!r}"})
+
+    def close(self) -> None:
+        self.requests.put(None)
+        self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def serve_stream(solver: BatchSolver, lines: Iterable[str],
+                 write: Callable[[str], None]) -> None:
+    # Responses go out in request order, while later requests keep being
+    # read and batched behind the ones being solved.
+    pending: queue.Queue = queue.Queue()
+
+    def writer() -> None:
+        connected = True
+        while True:
+            future = pending.get()
+            if future is None:
+                return
+            response = future.result()
+            if not connected:
+                continue
+            try:
+                write(json.dumps(response) + "\n")
+            except OSError:
+                connected = False
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+            except ValueError as error:
+                future: Future = Future()
+                future.set_result({"id": None, "error": str(error)})
+            else:
+                future = solver.submit(request)
+            pending.put(future)
+    finally:
+        pending.put(None)
+        thread.join()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "SolverServer"
+
+    def handle(self) -> None:
+        def write(text: str) -> None:
+            self.wfile.write(text.encode())
+
+        serve_stream(self.server.solver,
+                     (line.decode() for line in self.rfile), write)
+
+
+class SolverServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int, solver: BatchSolver) -> None:
+        # Only local clients; there is no authentication.
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.solver = solver
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Solve boards sent as JSON lines, on stdin/stdout or "
+                    "a local TCP port, in batches on a pool of worker "
+                    "processes.")
+    parser.add_argument("--port", type=int, default=None,
+                        help="listen on this port of 127.0.0.1 instead of "
+                             "stdin (0 picks a free one)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="solver processes (default: one per CPU, "
+                             "0 to solve in this process)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE,
+                        help="most requests per batch")
+    parser.add_argument("--wait", type=float, default=BATCH_WAIT * 1000,
+                        help="milliseconds a batch waits to fill up")
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers is not None \
+        else os.cpu_count() or 1
+    solver = BatchSolver(workers, args.batch, args.wait / 1000)
+    try:
+        if args.port is None:
+            def write(text: str) -> None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+
+            serve_stream(solver, sys.stdin, write)
+        else:
+            with SolverServer(args.port, solver) as server:
+                host, port = server.server_address
+                print(f"Listening on {host}:{port} with {workers} workers.",
+                      file=sys.stderr, flush=True)
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+    finally:
+        solver.close()
+        print(f"Solved {solver.boards} boards in {solver.batches} batches.",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import json
+import os
+import statistics
+import time
+from typing import NamedTuple
+import numpy as np
+import cv2 as cv
+from cv2.typing import MatLike
+from common import UNKNOWN_TILE, \
+    FLAG_TILE, \
+    RED_RANGE
+from probability import STANDARD_BOARDS
+
+Position = tuple[int, int]
+GridCoords = tuple[list[int], list[int]]
+
+WON = "won"
+LOST = "lost"
+# The bot ran out of moves without the game visibly ending.
+STUCK = "stuck"
+
+# Share of the face that has to differ from how it looked while playing.
+FACE_CHANGE = 0.02
+# Frames a changed face has to last, so the face pulled while a click is
+# held down isn't taken for the end of the game.
+FACE_FRAMES = 2
+# Share of a tile that has to be red for it to be the mine that went off;
+# a flag covers far less of its tile.
+EXPLODED_SHARE = 0.5
+
+
+class GameResult(NamedTuple):
+    outcome: str
+    seconds: float
+    guesses: int
+    clicks: int
+    frames: int
+
+
+def face_box(field: tuple[Position, Position],
+             field_grid: GridCoords) -> tuple[int, int, int, int] | None:
+    # The face sits in the middle of the panel between the top of the
+    # field and the first row of tiles.
+    (_, y_start), _ = field
+    x_coords, y_coords = field_grid
+    top, bottom = y_start, y_coords[0]
+    half = (bottom - top) // 4
+    if half < 2:
+        return None
+    x_center = (x_coords[0] + x_coords[-1]) // 2
+    y_center = (top + bottom) // 2
+    return x_center - half, y_center - half, x_center + half, y_center + half
+
+
+def face_center(field: tuple[Position, Position],
+                field_grid: GridCoords) -> Position | None:
+    box = face_box(field, field_grid)
+    if box is None:
+        return None
+    left, top, right, bottom = box
+    return (left + right) // 2, (top + bottom) // 2
+
+
+def shows_exploded_tile(image: MatLike, field_grid: GridCoords,
+                        shape: tuple[int, int]) -> bool:
+    x_coords, y_coords = field_grid
+    rows, cols = shape
+    tile_size = y_coords[1] - y_coords[0]
+    y_start, x_start = y_coords[0], x_coords[0]
+    region = image[y_start:y_start + rows * tile_size,
+                   x_start:x_start + cols * tile_size]
+    if region.shape[:2] != (rows * tile_size, cols * tile_size):
+        return False
+    red = cv.inRange(region, np.array(RED_RANGE[0]), np.array(RED_RANGE[1]))
+    counts = red.reshape(rows, tile_size, cols, tile_size).sum(
+        axis=(1, 3), dtype=np.int64) // 255
+    return bool(np.any(counts > EXPLODED_SHARE * tile_size * tile_size))
+
+
+class GameTracker:
+    def __init__(self, total_mines: int | None = None) -> None:
+        self.total_mines = total_mines
+        self.face: np.ndarray | None = None
+        self.changed = 0
+
+    def reset(self) -> None:
+        self.face = None
+        self.changed = 0
+
+    def _face_changed(self, image: MatLike,
+                      field: tuple[Position, Position],
+                      field_grid: GridCoords) -> bool:
+        box = face_box(field, field_grid)
+        if box is None:
+            return False
+        left, top, right, bottom = box
+        face = image[top:bottom, left:right]
+        if self.face is None or self.face.shape != face.shape:
+            # The first face of a game is the playing one.
+            self.face = face.copy()
+            self.changed = 0
+            return False
+        difference = np.abs(face.astype(np.int16) - self.face).sum(axis=2)
+        if np.count_nonzero(difference > 48) > FACE_CHANGE * \
+                difference.size:
+            self.changed += 1
+        else:
+            self.changed = 0
+        return self.changed >= FACE_FRAMES
+
+    def update(self, image: MatLike,
+               field: tuple[Position, Position],
+               field_grid: GridCoords,
+               board: np.ndarray) -> str | None:
+        # Only mines left covered is a win whatever the face shows, but
+        # that needs the real mine count; a guess from the board's size
+        # would misjudge custom boards.
+        mines = self.total_mines or STANDARD_BOARDS.get(board.shape)
+        covered = np.count_nonzero((board == UNKNOWN_TILE) |
+                                   (board == FLAG_TILE))
+        if self._face_changed(image, field, field_grid):
+            if mines is not None:
+                # Once a game is lost its mines are shown, so fewer tiles
+                # stay covered.
+                return WON if covered == mines else LOST
+            return LOST if shows_exploded_tile(image, field_grid,
+                                               board.shape) else WON
+        if covered == mines:
+            return WON
+        return None
+
+
+class SessionStats:
+    def __init__(self, log_path: str | None = None) -> None:
+        self.results: list[GameResult] = []
+        self.started = time.perf_counter()
+        self.log = open(log_path, "a") if log_path else None
+
+    def add(self, result: GameResult) -> None:
+        self.results.append(result)
+        print(f"Game {len(self.results)}: {result.outcome} in "
+              f"{result.seconds:.1f} s, {result.guesses} guesses, "
+              f"{result.clicks} clicks.")
+        if self.log is not None:
+            self.log.write(json.dumps({"game": len(self.results),
+                                       "timestamp": time.time(),
+                                       **result._asdict()}) + "\n")
+            self.log.flush()
+
+    def summary(self) -> dict:
+        games = len(self.results)
+        elapsed = time.perf_counter() - self.started
+        outcomes = [result.outcome for result in self.results]
+        return {"games": games,
+                "won": outcomes.count(WON),
+                "lost": outcomes.count(LOST),
+                "stuck": outcomes.count(STUCK),
+                "win_rate": outcomes.count(WON) / games if games else 0.0,
+                "guesses_per_game": statistics.mean(
+                    result.guesses for result in self.results)
+                if games else 0.0,
+                "seconds_per_game": statistics.mean(
+                    result.seconds for result in self.results)
+                if games else 0.0,
+                "games_per_hour": games * 3600 / elapsed if elapsed else 0.0}
+
+    def report(self) -> None:
+        summary = self.summary()
+        if not summary["games"]:
+            return
+        print(f"Session: {summary['games']} games, {summary['won']} won, "
+              f"{summary['lost']} lost, {summary['stuck']} stuck "
+              f"({summary['win_rate']:.0%} win rate), "
+              f"{summary['guesses_per_game']:.1f} guesses and "
+              f"{summary['seconds_per_game']:.1f} s per game, "
+              f"{summary['games_per_hour']:.0f} games per hour.")
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def load_session() -> tuple[int, float]:
+    # Games to play and minutes to play for; 0 leaves either unlimited,
+    # and both at 0 plays a single game.
+    return int(os.getenv("SESSION_GAMES", 0)), \
+        float(os.getenv("SESSION_MINUTES", 0))
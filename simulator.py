@@ -0,0 +1,405 @@
+import threading
+import cv2 as cv
+import numpy as np
+from common import VICINITY, \
+    TILE_SYMBOLS, \
+    UNKNOWN_TILE, \
+    FLAG_TILE, \
+    board_to_strings, \
+    neighbor_counts
+from backend import Region, \
+    crop_region
+from buffers import BufferPool
+
+Position = tuple[int, int]
+Color = tuple[int, int, int]
+
+PLAYING = "playing"
+WON = "won"
+LOST = "lost"
+
+# Sprites past the parser's symbols, only shown once a game is lost.
+MINE_TILE = len(TILE_SYMBOLS)
+EXPLODED_TILE = MINE_TILE + 1
+
+MAIN_COLOR: Color = (198, 198, 198)
+BACKGROUND_COLOR: Color = (64, 64, 64)
+LIGHT_COLOR: Color = (255, 255, 255)
+DARK_COLOR: Color = (128, 128, 128)
+DIGIT_COLORS: dict[str, Color] = {"1": (255, 0, 0),
+                                  "2": (0, 128, 0),
+                                  "3": (0, 0, 255),
+                                  "4": (128, 0, 0),
+                                  "5": (0, 0, 128),
+                                  "6": (128, 128, 0),
+                                  "7": (0, 0, 0),
+                                  "8": (128, 128, 128)}
+FLAG_COLOR: Color = (0, 0, 255)
+MINE_COLOR: Color = (0, 0, 0)
+FACE_COLOR: Color = (0, 255, 255)
+COUNTER_COLOR: Color = (0, 0, 0)
+
+# What the parser needs to line its grid up with rendered frames.
+TILE_PADDING = 2
+
+
+def generate_mines(rows: int, cols: int, mines: int,
+                   seed: int | None = None,
+                   safe: Position | None = None) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    allowed = np.ones((rows, cols), dtype=bool)
+    if safe is not None:
+        y, x = safe
+        allowed[max(y - 1, 0):y + 2, max(x - 1, 0):x + 2] = False
+        if np.count_nonzero(allowed) < mines:
+            allowed[:] = True
+            allowed[y, x] = False
+    candidates = np.flatnonzero(allowed)
+    chosen = rng.choice(candidates, size=min(mines, len(candidates)),
+                        replace=False)
+    field = np.zeros(rows * cols, dtype=bool)
+    field[chosen] = True
+    return field.reshape(rows, cols)
+
+
+class Game:
+    def __init__(self, rows: int, cols: int, mines: int,
+                 seed: int | None = None) -> None:
+        self.rows, self.cols, self.num_mines = rows, cols, mines
+        self.seed = seed
+        self.mines: np.ndarray | None = None
+        self.counts = np.zeros((rows, cols), dtype=np.uint8)
+        self.zero_labels = np.zeros((rows, cols), dtype=np.int32)
+        self.zero_boxes = np.zeros((0, 5), dtype=np.int32)
+        self.revealed = np.zeros((rows, cols), dtype=bool)
+        self.revealed_count = 0
+        self.flagged = np.zeros((rows, cols), dtype=bool)
+        self.state = PLAYING
+        self.exploded: Position | None = None
+
+    def _place_mines(self, safe: Position) -> None:
+        # Like Minesweeper Online, the first click always opens an area.
+        self.mines = generate_mines(self.rows, self.cols, self.num_mines,
+                                    self.seed, safe)
+        self.counts = neighbor_counts(self.mines)
+        zeros = ((self.counts == 0) & ~self.mines).astype(np.uint8)
+        _, self.zero_labels, self.zero_boxes, _ = \
+            cv.connectedComponentsWithStats(zeros, connectivity=8)
+
+    def in_bounds(self, y: int, x: int) -> bool:
+        return 0 <= y < self.rows and 0 <= x < self.cols
+
+    def reveal(self, y: int, x: int) -> int:
+        if self.state != PLAYING or not self.in_bounds(y, x) or \
+                self.revealed[y, x] or self.flagged[y, x]:
+            return 0
+        if self.mines is None:
+            self._place_mines((y, x))
+        if self.mines[y, x]:
+            self.state = LOST
+            self.exploded = (y, x)
+            return 0
+
+        if self.counts[y, x] == 0:
+            # A zero opens its whole 8-connected zero region plus the
+            # numbers bordering it.
+            label = self.zero_labels[y, x]
+            left, top, width, height, _ = self.zero_boxes[label]
+            y_start, x_start = max(top - 1, 0), max(left - 1, 0)
+            y_end = min(top + height + 1, self.rows)
+            x_end = min(left + width + 1, self.cols)
+            region = (self.zero_labels[y_start:y_end, x_start:x_end] ==
+                      label).astype(np.uint8)
+            region = cv.dilate(region, np.ones((3, 3), dtype=np.uint8))
+            revealed = self.revealed[y_start:y_end, x_start:x_end]
+            opened = (region > 0) & ~revealed & \
+                ~self.flagged[y_start:y_end, x_start:x_end]
+            revealed |= opened
+            count = int(np.count_nonzero(opened))
+        else:
+            self.revealed[y, x] = True
+            count = 1
+
+        self.revealed_count += count
+        if self.revealed_count == self.rows * self.cols - self.num_mines:
+            self.state = WON
+            self.flagged = self.mines.copy()
+        return count
+
+    def flag(self, y: int, x: int) -> None:
+        if self.state == PLAYING and self.in_bounds(y, x) and \
+                not self.revealed[y, x]:
+            self.flagged[y, x] = not self.flagged[y, x]
+
+    def chord(self, y: int, x: int) -> int:
+        if self.state != PLAYING or not self.in_bounds(y, x) or \
+                not self.revealed[y, x]:
+            return 0
+        neighbors = [(y + i, x + j) for j, i in VICINITY
+                     if self.in_bounds(y + i, x + j)]
+        if sum(self.flagged[i, j] for i, j in neighbors) != \
+                self.counts[y, x]:
+            return 0
+        return sum(self.reveal(i, j) for i, j in neighbors)
+
+    def board(self) -> np.ndarray:
+        board = self.counts.copy()
+        board[~self.revealed] = UNKNOWN_TILE
+        board[self.flagged & ~self.revealed] = FLAG_TILE
+        return board
+
+    def minefield(self) -> list[str]:
+        return board_to_strings(self.board())
+
+    def visible(self) -> np.ndarray:
+        board = self.board()
+        if self.state == LOST:
+            board[self.mines & ~self.flagged] = MINE_TILE
+            board[self.exploded] = EXPLODED_TILE
+        return board
+
+
+def _bevel(tile: np.ndarray, width: int,
+           top_left: Color, bottom_right: Color) -> None:
+    tile[:width, :] = top_left
+    tile[:, :width] = top_left
+    tile[-width:, width:] = bottom_right
+    tile[width:, -width:] = bottom_right
+
+
+def tile_sprites(tile_size: int) -> np.ndarray:
+    bevel = max(1, tile_size // 8)
+    inner = slice(2, tile_size - 1)
+    small = slice(max(2, tile_size // 4), tile_size - max(2, tile_size // 4))
+
+    revealed = np.full((tile_size, tile_size, 3), MAIN_COLOR, dtype=np.uint8)
+    revealed[0, :] = DARK_COLOR
+    revealed[:, 0] = DARK_COLOR
+    covered = np.full((tile_size, tile_size, 3), MAIN_COLOR, dtype=np.uint8)
+    _bevel(covered, bevel, LIGHT_COLOR, DARK_COLOR)
+
+    sprites = np.zeros((EXPLODED_TILE + 1, tile_size, tile_size, 3),
+                       dtype=np.uint8)
+    sprites[0] = revealed
+    for symbol, color in DIGIT_COLORS.items():
+        sprite = revealed.copy()
+        if symbol == "8":
+            sprite[inner, inner] = color
+        else:
+            sprite[small, small] = color
+        sprites[int(symbol)] = sprite
+
+    sprites[UNKNOWN_TILE] = covered
+    flag = covered.copy()
+    flag[small, small] = FLAG_COLOR
+    flag[small.start:small.stop, tile_size // 2] = MINE_COLOR
+    sprites[FLAG_TILE] = flag
+
+    mine = revealed.copy()
+    mine[small, small] = MINE_COLOR
+    sprites[MINE_TILE] = mine
+    exploded = mine.copy()
+    exploded[1:, 1:][exploded[1:, 1:].sum(axis=2) == sum(MAIN_COLOR)] = \
+        FLAG_COLOR
+    sprites[EXPLODED_TILE] = exploded
+    return sprites
+
+
+class Renderer:
+    def __init__(self, rows: int, cols: int, tile_size: int = 16,
+                 right_half: bool = True) -> None:
+        self.rows, self.cols, self.tile_size = rows, cols, tile_size
+        self.sprites = tile_sprites(tile_size)
+        self.border = max(1, tile_size // 8)
+        self.margin = max(4, tile_size // 2)
+        self.panel = 2 * tile_size
+
+        board_width = cols * tile_size + 2 * self.border
+        board_height = rows * tile_size + 2 * self.border
+        self.field_width = board_width + 2 * self.margin
+        self.field_height = board_height + self.panel + 3 * self.margin
+
+        # By default the field sits on the right half of the frame, where
+        # hint.py looks for it.
+        self.width = self.field_width + 2 * self.margin
+        if right_half:
+            self.width += self.field_width
+        self.height = self.field_height + 2 * self.margin
+        self.field_x = self.width - self.field_width - self.margin
+        self.field_y = self.margin
+        self.board_x = self.field_x + self.margin + self.border
+        self.board_y = self.field_y + 2 * self.margin + self.panel + \
+            self.border
+
+        face_size = self.panel - 2 * self.border
+        self.face_x = self.field_x + (self.field_width - face_size) // 2
+        self.face_y = self.field_y + self.margin + self.border
+        self.face_size = face_size
+
+        self.frame = self._draw_frame()
+        self.board: np.ndarray | None = None
+        self.state: str | None = None
+
+    @property
+    def field_padding(self) -> int:
+        return self.border + 1
+
+    def _draw_frame(self) -> np.ndarray:
+        frame = np.full((self.height, self.width, 3), BACKGROUND_COLOR,
+                        dtype=np.uint8)
+        frame[self.field_y:self.field_y + self.field_height,
+              self.field_x:self.field_x + self.field_width] = MAIN_COLOR
+
+        x_start, y_start = self.board_x - self.border, \
+            self.board_y - self.border
+        sunken = frame[y_start:self.board_y + self.rows * self.tile_size +
+                       self.border,
+                       x_start:self.board_x + self.cols * self.tile_size +
+                       self.border]
+        _bevel(sunken, self.border, DARK_COLOR, LIGHT_COLOR)
+
+        counter_width = min(3 * self.tile_size,
+                            (self.field_width - self.panel) // 3)
+        counter_y = slice(self.face_y, self.face_y + self.face_size)
+        frame[counter_y, self.field_x + self.margin:
+              self.field_x + self.margin + counter_width] = COUNTER_COLOR
+        right = self.field_x + self.field_width - self.margin
+        frame[counter_y, right - counter_width:right] = COUNTER_COLOR
+        return frame
+
+    def _draw_face(self, state: str) -> None:
+        size = self.face_size
+        face = self.frame[self.face_y:self.face_y + size,
+                          self.face_x:self.face_x + size]
+        _bevel(face, self.border, LIGHT_COLOR, DARK_COLOR)
+        face[self.border:-self.border, self.border:-self.border] = \
+            FACE_COLOR
+        eyes = slice(size // 3, size // 3 + max(1, size // 8))
+        if state == WON:
+            face[eyes, size // 5:size - size // 5] = MINE_COLOR
+        elif state == LOST:
+            face[eyes, size // 5:size - size // 5] = FLAG_COLOR
+        else:
+            face[eyes, size // 4:size // 4 + max(1, size // 8)] = MINE_COLOR
+            face[eyes, size - size // 4 - max(1, size // 8):
+                 size - size // 4] = MINE_COLOR
+
+    def render(self, visible: np.ndarray, state: str = PLAYING) \
+            -> np.ndarray:
+        tile_size = self.tile_size
+        if self.board is None:
+            changed = np.ones(visible.shape, dtype=bool)
+        else:
+            changed = visible != self.board
+        if changed.all():
+            tiles = self.sprites[visible].transpose(0, 2, 1, 3, 4)
+            self.frame[self.board_y:self.board_y + self.rows * tile_size,
+                       self.board_x:self.board_x + self.cols * tile_size] = \
+                tiles.reshape(self.rows * tile_size, self.cols * tile_size,
+                              3)
+        else:
+            for y, x in zip(*np.nonzero(changed)):
+                top = self.board_y + y * tile_size
+                left = self.board_x + x * tile_size
+                self.frame[top:top + tile_size, left:left + tile_size] = \
+                    self.sprites[visible[y, x]]
+        if state != self.state:
+            self._draw_face(state)
+        if self.board is None:
+            self.board = visible.copy()
+        else:
+            np.copyto(self.board, visible)
+        self.state = state
+        return self.frame
+
+    def tile_at(self, x: int, y: int) -> Position | None:
+        row = (y - self.board_y) // self.tile_size
+        col = (x - self.board_x) // self.tile_size
+        if y < self.board_y or x < self.board_x or \
+                row >= self.rows or col >= self.cols:
+            return None
+        return row, col
+
+    def on_face(self, x: int, y: int) -> bool:
+        return self.face_x <= x < self.face_x + self.face_size and \
+            self.face_y <= y < self.face_y + self.face_size
+
+
+class SimulatorBackend:
+    def __init__(self, rows: int, cols: int, mines: int,
+                 seed: int | None = None,
+                 tile_size: int = 16,
+                 opening: bool = True,
+                 boards: int = 1) -> None:
+        self.rows, self.cols, self.mines = rows, cols, mines
+        self.seed = seed
+        self.opening = opening
+        self.games = 0
+        # Several boards are laid side by side, each playing its own game;
+        # a single one keeps to the right half of the frame.
+        boards = max(boards, 1)
+        self.renderers = [Renderer(rows, cols, tile_size, boards == 1)
+                          for _ in range(boards)]
+        self.renderer = self.renderers[0]
+        self.tile_padding = TILE_PADDING
+        self.field_padding = self.renderer.field_padding
+        self.clicks = 0
+        # Screenshots may come from a capture thread while clicks land.
+        self.lock = threading.Lock()
+        self.buffers = BufferPool()
+        self.boards: list[Game] = []
+        for index in range(boards):
+            self.boards.append(self.new_game(index))
+
+    @property
+    def game(self) -> Game:
+        return self.boards[0]
+
+    def new_game(self, index: int = 0) -> Game:
+        seed = None if self.seed is None else self.seed + self.games
+        self.games += 1
+        game = Game(self.rows, self.cols, self.mines, seed)
+        if self.opening:
+            # The parser needs an uncovered tile to measure the grid.
+            game.reveal(self.rows // 2, self.cols // 2)
+        if index < len(self.boards):
+            self.boards[index] = game
+        return game
+
+    def screenshot(self, region: Region | None = None) -> np.ndarray:
+        with self.lock:
+            frames = [renderer.render(game.visible(), game.state)
+                      for renderer, game in zip(self.renderers, self.boards)]
+            frame = frames[0]
+            if len(frames) > 1:
+                frame = np.concatenate(frames, axis=1, out=self.buffers.get(
+                    "boards", (frame.shape[0], frame.shape[1] * len(frames),
+                               3)))
+            frame = crop_region(frame, region)
+            return cv.cvtColor(frame, cv.COLOR_BGR2RGB,
+                               dst=self.buffers.get("frame", frame.shape))
+
+    def click(self, x: float, y: float, button: str = "left") -> None:
+        with self.lock:
+            self._click(x, y, button)
+
+    def _click(self, x: float, y: float, button: str) -> None:
+        self.clicks += 1
+        x, y = int(x), int(y)
+        index = x // self.renderer.width
+        if x < 0 or index >= len(self.boards):
+            return
+        x -= index * self.renderer.width
+        renderer, game = self.renderers[index], self.boards[index]
+        if renderer.on_face(x, y):
+            self.new_game(index)
+            return
+        tile = renderer.tile_at(x, y)
+        if tile is None:
+            return
+        if button == "right":
+            game.flag(*tile)
+        elif game.revealed[tile]:
+            game.chord(*tile)
+        else:
+            game.reveal(*tile)
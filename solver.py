@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from typing import NamedTuple, \
+    TYPE_CHECKING
+import numpy as np
+from propagation import propagate, \
+    NO_LABEL, \
+    SAFE, \
+    DANGEROUS
+from frontier import frontier_components, \
+    apply_frontier, \
+    NODE_LIMIT
+
+if TYPE_CHECKING:
+    from parallel import ParallelSolver
+
+Position = tuple[int, int]
+
+# The tier whose rule made each deduction; 0 where nothing was decided.
+SINGLE = 1
+SUBSET = 2
+SEARCH = 3
+TIER_NAMES = {SINGLE: "single", SUBSET: "subset", SEARCH: "search"}
+
+
+class Solution(NamedTuple):
+    labels: np.ndarray
+    tiers: np.ndarray
+    # False when the budget ran out before every tier had finished. The
+    # budget is only checked between steps, so a solve can overrun it by
+    # about one whole-board pass.
+    complete: bool
+
+
+def _expired(deadline: float | None) -> bool:
+    return deadline is not None and time.perf_counter() >= deadline
+
+
+def _mark(tiers: np.ndarray, labels: np.ndarray, tier: int) -> None:
+    tiers[(labels != NO_LABEL) & (tiers == 0)] = tier
+
+
+def subset_deductions(board: np.ndarray, labels: np.ndarray,
+                      deadline: float | None = None) \
+        -> tuple[set[Position], set[Position]]:
+    safe: set[Position] = set()
+    mines: set[Position] = set()
+    for component in frontier_components(board, labels):
+        if _expired(deadline):
+            break
+        constraints = [(frozenset(members), need)
+                       for members, need in component.constraints]
+        if any(need < 0 or need > len(members)
+               for members, need in constraints):
+            continue
+        cell_constraints: dict[int, list[int]] = {}
+        for index, (members, _) in enumerate(constraints):
+            for member in members:
+                cell_constraints.setdefault(member, []).append(index)
+        pairs = {(first, second)
+                 for indices in cell_constraints.values()
+                 for position, first in enumerate(indices)
+                 for second in indices[position + 1:]}
+
+        # Two numbers that share cells bound how many mines the shared
+        # cells hold, and with it how many each keeps to itself.
+        for first, second in pairs:
+            first_cells, first_need = constraints[first]
+            second_cells, second_need = constraints[second]
+            first_only = first_cells - second_cells
+            second_only = second_cells - first_cells
+            shared = len(first_cells) - len(first_only)
+            low = max(0, first_need - len(first_only),
+                      second_need - len(second_only))
+            high = min(shared, first_need, second_need)
+            if low > high:
+                continue
+            for only, need in ((first_only, first_need),
+                               (second_only, second_need)):
+                if not only:
+                    continue
+                if need == low:
+                    safe.update(component.cells[cell] for cell in only)
+                elif need - high == len(only):
+                    mines.update(component.cells[cell] for cell in only)
+    return safe, mines
+
+
+def solve_board(board: np.ndarray, budget: float | None = None,
+                check_flags: bool = True,
+                node_limit: int = NODE_LIMIT) -> Solution:
+    # Cheap tiers run first and everything they decide is taken out of
+    # the search, so a budget cut short still leaves their deductions.
+    deadline = None if budget is None else time.perf_counter() + budget
+    tiers = np.zeros(board.shape, dtype=np.uint8)
+    labels = propagate(board, check_flags=check_flags, deadline=deadline)
+    _mark(tiers, labels, SINGLE)
+    # One round of pair rules settles most of what the search would; more
+    # rounds cost more than the search they spare.
+    safe, mines = set(), set()
+    if not _expired(deadline):
+        safe, mines = subset_deductions(board, labels, deadline)
+    if safe or mines:
+        changed = np.zeros(board.shape, dtype=bool)
+        for cells, label in ((safe, SAFE), (mines, DANGEROUS)):
+            if cells:
+                ys, xs = zip(*cells)
+                labels[ys, xs] = label
+                changed[ys, xs] = True
+        _mark(tiers, labels, SUBSET)
+        labels = propagate(board, labels, check_flags, deadline, changed)
+        _mark(tiers, labels, SINGLE)
+    if not _expired(deadline):
+        apply_frontier(board, labels, node_limit, deadline)
+        _mark(tiers, labels, SEARCH)
+    return Solution(labels, tiers, not _expired(deadline))
+
+
+class Solver:
+    def __init__(self, budget: float | None = None,
+                 parallel: "ParallelSolver | None" = None,
+                 node_limit: int = NODE_LIMIT) -> None:
+        self.budget = budget
+        self.parallel = parallel
+        self.node_limit = node_limit
+        self.deductions = dict.fromkeys(TIER_NAMES, 0)
+        self.solves = 0
+        self.incomplete = 0
+        # Boards may be solved from several threads at once; the pool and
+        # its shared blocks only take one board at a time.
+        self.lock = threading.Lock()
+
+    def solve(self, board: np.ndarray, check_flags: bool = True) \
+            -> Solution:
+        if self.parallel is not None:
+            with self.lock:
+                solution = self.parallel.solve(board, check_flags,
+                                               self.node_limit, self.budget)
+        else:
+            solution = solve_board(board, self.budget, check_flags,
+                                   self.node_limit)
+        counts = np.bincount(solution.tiers.ravel(),
+                             minlength=len(TIER_NAMES) + 1)
+        with self.lock:
+            self.solves += 1
+            self.incomplete += not solution.complete
+            for tier in self.deductions:
+                self.deductions[tier] += int(counts[tier])
+        return solution
+
+    def report(self) -> None:
+        if not self.solves:
+            return
+        tiers = ", ".join(f"{self.deductions[tier]} {name}"
+                          for tier, name in TIER_NAMES.items())
+        print(f"Solver: {self.solves} boards, {self.incomplete} cut short "
+              f"by the budget; labels by tier: {tiers}.")
+        if self.parallel is not None:
+            print(f"Parallel solver: {self.parallel.jobs} region jobs.")
+
+    def close(self) -> None:
+        if self.parallel is not None:
+            self.parallel.close()
+
+
+UNLIMITED = Solver()
+
+
+def load_solver() -> Solver:
+    from parallel import load_parallel
+    budget = float(os.getenv("SOLVE_BUDGET", 0)) / 1000
+    return Solver(budget or None, load_parallel())